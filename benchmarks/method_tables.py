@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Compare table-driven method and scheme conversions with `isinstance`/`match` chains.
+
+This runs natively (i.e. outside of a Wasm host) and times, using `timeit`,
+the conversions performed when decoding an incoming request (`wasi:http`
+method to name) and encoding an outgoing one (method and scheme names to
+`wasi:http` variants).  The `*_chain` functions reproduce the `isinstance`
+and `match` chains the SDK used before `_method_name`, `_method_from_name`
+and `_scheme_from_name` were introduced.
+
+Usage: `python benchmarks/method_tables.py` from the repository root.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from spin_sdk.http import _method_name, _method_from_name, _scheme_from_name
+from spin_sdk.wit.imports.types import (
+    Method, Method_Get, Method_Head, Method_Post, Method_Put, Method_Delete, Method_Connect, Method_Options,
+    Method_Trace, Method_Patch, Method_Other, Scheme, Scheme_Http, Scheme_Https, Scheme_Other
+)
+
+NUMBER = 200_000
+
+def method_name_chain(method: Method) -> str:
+    if isinstance(method, Method_Get):
+        return "GET"
+    elif isinstance(method, Method_Head):
+        return "HEAD"
+    elif isinstance(method, Method_Post):
+        return "POST"
+    elif isinstance(method, Method_Put):
+        return "PUT"
+    elif isinstance(method, Method_Delete):
+        return "DELETE"
+    elif isinstance(method, Method_Connect):
+        return "CONNECT"
+    elif isinstance(method, Method_Options):
+        return "OPTIONS"
+    elif isinstance(method, Method_Trace):
+        return "TRACE"
+    elif isinstance(method, Method_Patch):
+        return "PATCH"
+    elif isinstance(method, Method_Other):
+        return method.value
+    else:
+        raise AssertionError
+
+def method_from_name_chain(name: str) -> Method:
+    match name:
+        case "GET":
+            return Method_Get()
+        case "HEAD":
+            return Method_Head()
+        case "POST":
+            return Method_Post()
+        case "PUT":
+            return Method_Put()
+        case "DELETE":
+            return Method_Delete()
+        case "CONNECT":
+            return Method_Connect()
+        case "OPTIONS":
+            return Method_Options()
+        case "TRACE":
+            return Method_Trace()
+        case "PATCH":
+            return Method_Patch()
+        case _:
+            return Method_Other(name)
+
+def scheme_from_name_chain(name: str) -> Scheme:
+    match name:
+        case "http":
+            return Scheme_Http()
+        case "https":
+            return Scheme_Https()
+        case "":
+            return Scheme_Http()
+        case _:
+            return Scheme_Other(name)
+
+def measure(function, argument) -> float:
+    """Return the mean time, in nanoseconds, of calling `function(argument)`."""
+    seconds = min(timeit.repeat(lambda: function(argument), number=NUMBER, repeat=5))
+    return seconds / NUMBER * 1e9
+
+def main():
+    cases = [
+        ("decode", "GET", method_name_chain, _method_name, Method_Get()),
+        ("decode", "PATCH", method_name_chain, _method_name, Method_Patch()),
+        ("decode", "other", method_name_chain, _method_name, Method_Other("PURGE")),
+        ("encode", "GET", method_from_name_chain, _method_from_name, "GET"),
+        ("encode", "PATCH", method_from_name_chain, _method_from_name, "PATCH"),
+        ("encode", "other", method_from_name_chain, _method_from_name, "PURGE"),
+        ("scheme", "https", scheme_from_name_chain, _scheme_from_name, "https"),
+        ("scheme", "other", scheme_from_name_chain, _scheme_from_name, "ftp"),
+    ]
+    print(f"{'conversion':>10} {'input':>6} {'chain ns':>9} {'table ns':>9} {'speedup':>8}")
+    for conversion, label, chain, table, argument in cases:
+        old = measure(chain, argument)
+        new = measure(table, argument)
+        print(f"{conversion:>10} {label:>6} {old:>9.1f} {new:>9.1f} {old / new:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Compare fixed and adaptive `Stream` read sizes across body sizes.
+
+This runs natively (i.e. outside of a Wasm host) by reading from a fake
+`wasi:io/streams#input-stream` which delivers data in bursts of `BURST`
+bytes, as a host reading from a socket might.  For each body size it reports
+the number of host read calls and the mean number of bytes requested per
+call, first with the read size fixed at `poll_loop.READ_SIZE` (the old
+behaviour) and then with the default adaptive bounds.
+
+Usage: `python benchmarks/stream_read_sizes.py` from the repository root.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from spin_sdk.wit.types import Err
+from spin_sdk.wit.imports.streams import StreamError_Closed
+from spin_sdk.http import poll_loop
+from spin_sdk.http.poll_loop import Stream
+
+BURST = 256 * 1024
+
+class FakeInputStream:
+    def __init__(self, size: int):
+        self.remaining = size
+        self.available = 0
+        self.reads = 0
+        self.requested = 0
+
+    def blocking_read(self, size: int) -> bytes:
+        self.reads += 1
+        self.requested += size
+        if self.remaining == 0:
+            raise Err(StreamError_Closed())
+        if self.available == 0:
+            self.available = min(BURST, self.remaining)
+        count = min(size, self.available)
+        self.available -= count
+        self.remaining -= count
+        return bytes(count)
+
+    def __exit__(self, *args):
+        pass
+
+class FakeIncomingBody:
+    def __init__(self, size: int):
+        self.input = FakeInputStream(size)
+
+    def stream(self) -> FakeInputStream:
+        return self.input
+
+poll_loop.IncomingBody.finish = classmethod(lambda cls, body: None)
+
+def measure(size: int, **bounds) -> FakeInputStream:
+    body = FakeIncomingBody(size)
+    total = sum(len(chunk) for chunk in Stream(body, **bounds))
+    assert total == size
+    return body.input
+
+def main():
+    fixed = {"min_read_size": poll_loop.READ_SIZE, "max_read_size": poll_loop.READ_SIZE}
+    print(f"{'body size':>10} {'fixed reads':>12} {'bytes/read':>11} {'adaptive reads':>15} {'bytes/read':>11}")
+    for size in (512, 16 * 1024, 256 * 1024, 4 * 1024 * 1024, 64 * 1024 * 1024):
+        a = measure(size, **fixed)
+        b = measure(size)
+        print(
+            f"{size:>10} {a.reads:>12} {a.requested // a.reads:>11} "
+            f"{b.reads:>15} {b.requested // b.reads:>11}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,171 @@
 """Module with helpers for wasi http"""
 
 import asyncio
+import hashlib
+import inspect
+import math
+import random
 import traceback
+import secrets
+import zlib
+from abc import ABC, abstractmethod
 from spin_sdk.http import poll_loop
-from spin_sdk.http.poll_loop import PollLoop, Sink, Stream
+from spin_sdk.http.poll_loop import Sink, Stream
 from spin_sdk.wit.types import Ok, Err
+from spin_sdk.wit.imports import monotonic_clock
 from spin_sdk.wit.imports.types import (
     IncomingResponse, Method, Method_Get, Method_Head, Method_Post, Method_Put, Method_Delete, Method_Connect, Method_Options,
-    Method_Trace, Method_Patch, Method_Other, IncomingRequest, IncomingBody, ResponseOutparam, OutgoingResponse,
-    Fields, Scheme, Scheme_Http, Scheme_Https, Scheme_Other, OutgoingRequest, OutgoingBody
+    Method_Trace, Method_Patch, Method_Other, IncomingRequest, ResponseOutparam, OutgoingResponse,
+    Fields, Scheme, Scheme_Http, Scheme_Https, Scheme_Other, OutgoingRequest,
+    RequestOptions, ErrorCode_HttpResponseContentCoding, ErrorCode_HttpRequestBodySize, ErrorCode_HttpResponseBodySize,
+    ErrorCode_HttpResponseTimeout, ErrorCode_DnsTimeout, ErrorCode_DestinationUnavailable, ErrorCode_ConnectionRefused,
+    ErrorCode_ConnectionTerminated, ErrorCode_ConnectionTimeout, ErrorCode_ConnectionReadTimeout,
+    ErrorCode_ConnectionWriteTimeout, ErrorCode_ConnectionLimitReached, ErrorCode_HttpResponseIncomplete
+)
+from dataclasses import dataclass, fields as dataclass_fields
+from collections import deque
+from contextvars import ContextVar, Token
+from collections.abc import Mapping, MutableMapping
+from typing import (
+    Any, AsyncGenerator, AsyncIterable, AsyncIterator, BinaryIO, Callable, Deque, Dict, FrozenSet, Iterable, Iterator, List,
+    Optional, Set, Tuple, Union, cast
 )
-from spin_sdk.wit.imports.streams import StreamError_Closed
-from dataclasses import dataclass
-from collections.abc import MutableMapping
-from typing import Optional
 from urllib import parse
+from email import utils
+from datetime import datetime, timezone
+
+Body = Union[bytes, bytearray, Iterable[bytes], AsyncIterable[bytes], BinaryIO]
+"""Types accepted as a request or response body.
+
+Besides a fully materialized `bytes` or `bytearray` object, a body may be an iterable or
+async iterable (e.g. a generator) yielding chunks of bytes, or a binary
+file-like object with a `read` method.  Such bodies are streamed to the
+peer as they are produced and, unless a `content-length` header is
+provided, sent using chunked transfer encoding.
+"""
+
+# Conversions between `wasi:http` methods and schemes and their names.  Both
+# the inbound and outbound paths use these, and outbound requests share a
+# single instance of each standard method and scheme.
+_METHOD_NAMES: Dict[type, str] = {
+    Method_Get: "GET",
+    Method_Head: "HEAD",
+    Method_Post: "POST",
+    Method_Put: "PUT",
+    Method_Delete: "DELETE",
+    Method_Connect: "CONNECT",
+    Method_Options: "OPTIONS",
+    Method_Trace: "TRACE",
+    Method_Patch: "PATCH",
+}
+_METHODS: Dict[str, Method] = {name: method_type() for method_type, name in _METHOD_NAMES.items()}
+_SCHEMES: Dict[str, Scheme] = {"http": Scheme_Http(), "https": Scheme_Https(), "": Scheme_Http()}
+
+def _method_name(method: Method) -> str:
+    """Return the name of the specified `wasi:http` method, e.g. `"GET"`."""
+    name = _METHOD_NAMES.get(type(method))
+    if name is not None:
+        return name
+    elif isinstance(method, Method_Other):
+        return method.value
+    else:
+        raise AssertionError
+
+def _method_from_name(name: str) -> Method:
+    """Return the `wasi:http` method with the specified name."""
+    method = _METHODS.get(name)
+    return method if method is not None else Method_Other(name)
+
+def _scheme_from_name(name: str) -> Scheme:
+    """Return the `wasi:http` scheme with the specified name, defaulting to HTTP if empty."""
+    scheme = _SCHEMES.get(name)
+    return scheme if scheme is not None else Scheme_Other(name)
+
+class Headers(MutableMapping[str, str]):
+    """HTTP header fields, which may hold several values per name.
+
+    Names are case-insensitive.  Values are kept as the raw bytes received
+    and only decoded from UTF-8 when read.  Indexing returns the last value
+    for a name; use `get_all` to get every value and `add` to append one.  An
+    unmodified instance is passed back to `wasi:http` as-is, so forwarding
+    headers doesn't require decoding or re-encoding them.
+    """
+
+    def __init__(self, entries: Optional[Iterable[Tuple[str, bytes]]] = None):
+        self._entries: List[Tuple[str, bytes]] = list(entries or [])
+        # Maps each lower-cased name to the indexes of its entries, built on
+        # first lookup and discarded on modification.
+        self._index: Optional[Dict[str, List[int]]] = None
+
+    @classmethod
+    def _wrap(cls, entries: List[Tuple[str, bytes]]) -> "Headers":
+        # Take ownership of `entries` rather than copying it; the caller must
+        # not keep using the list.
+        headers = cls.__new__(cls)
+        headers._entries = entries
+        headers._index = None
+        return headers
+
+    def entries(self) -> List[Tuple[str, bytes]]:
+        """Return the raw `(name, value)` pairs, in order.
+
+        This is the instance's own list, so it must not be modified.
+        """
+        return self._entries
+
+    def get_all(self, name: str) -> List[str]:
+        """Return every value for `name`, in order."""
+        return [str(self._entries[i][1], "utf-8") for i in self._lookup(name)]
+
+    def add(self, name: str, value: str):
+        """Append a value for `name`, keeping any existing values."""
+        self._entries.append((name.lower(), bytes(value, "utf-8")))
+        self._index = None
+
+    def copy(self) -> "Headers":
+        return Headers._wrap(list(self._entries))
+
+    def _indexes(self) -> Dict[str, List[int]]:
+        if self._index is None:
+            index: Dict[str, List[int]] = {}
+            for i, (entry_name, _) in enumerate(self._entries):
+                index.setdefault(entry_name.lower(), []).append(i)
+            self._index = index
+        return self._index
+
+    def _lookup(self, name: str) -> List[int]:
+        return self._indexes().get(name.lower(), [])
+
+    def __getitem__(self, name: str) -> str:
+        indexes = self._lookup(name)
+        if not indexes:
+            raise KeyError(name)
+        return str(self._entries[indexes[-1]][1], "utf-8")
+
+    def __setitem__(self, name: str, value: str):
+        lower = name.lower()
+        self._entries = [entry for entry in self._entries if entry[0].lower() != lower]
+        self._entries.append((lower, bytes(value, "utf-8")))
+        self._index = None
+
+    def __delitem__(self, name: str):
+        if not self._lookup(name):
+            raise KeyError(name)
+        lower = name.lower()
+        self._entries = [entry for entry in self._entries if entry[0].lower() != lower]
+        self._index = None
+
+    def __contains__(self, name: object) -> bool:
+        return isinstance(name, str) and bool(self._lookup(name))
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._indexes())
+
+    def __len__(self) -> int:
+        return len(self._indexes())
+
+    def __repr__(self) -> str:
+        return f"Headers({self._entries!r})"
 
 @dataclass
 class Request:
@@ -22,177 +173,1059 @@ class Request:
     method: str
     uri: str
     headers: MutableMapping[str, str]
-    body: Optional[bytes]
+    """The request headers.
+
+    For incoming requests this is a `Headers` instance.  Outgoing requests
+    accept any mapping, e.g. a `dict`.
+    """
+    body: Optional[Body]
+    """The request body.
+
+    For incoming requests this is a `bytearray` unless the handler has
+    opted into streaming via `IncomingHandler.stream_request_body`, in which
+    case it is a `spin_sdk.http.poll_loop.Stream` which may be iterated using
+    either `for` or `async for`.
+
+    Outgoing requests accept any `Body`, including a `Stream` received from
+    another request or response, which allows relaying a body without
+    buffering it.
+    """
+
+class RangeSource(ABC):
+    """A response body which can be read piecewise without reading it all.
+
+    Returning one of these as the body of a `Response` from a handler lets
+    `range_requests` (see `IncomingHandler`) read only the byte ranges the
+    client asked for, e.g. via ranged outbound requests (see
+    `RemoteRangeSource`) or by fetching only the relevant chunks of a value
+    split across several key-value store entries.  Without a `range`
+    header, the whole body is read using `read_range(0, size)`.
+    """
+
+    @property
+    @abstractmethod
+    def size(self) -> int:
+        """The total length of the body in bytes."""
+
+    @abstractmethod
+    def read_range(self, start: int, end: int) -> Body:
+        """Return the bytes from offset `start` up to, but not including, `end`."""
+
+class RemoteRangeSource(RangeSource):
+    """A `RangeSource` which fetches each range from a URL using `send_async`.
+
+    `size` must be the total length of the resource at `url`, e.g. from the
+    `content-length` of a previous `HEAD` request.  `headers` are included in
+    each request.
+    """
+
+    def __init__(self, url: str, size: int, headers: Optional[Mapping[str, str]] = None):
+        self.url = url
+        self._size = size
+        self.headers = headers if headers is not None else {}
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def read_range(self, start: int, end: int) -> Body:
+        return self._fetch(start, end)
+
+    async def _fetch(self, start: int, end: int) -> AsyncIterator[bytes]:
+        if start >= end:
+            return
+        headers = Headers(_header_entries(self.headers))
+        headers["range"] = f"bytes={start}-{end - 1}"
+        response = await send_async(Request("GET", self.url, headers, None), stream=True, decompress=False)
+        body = cast(Stream, response.body)
+        try:
+            if response.status == 206:
+                async for chunk in body:
+                    yield chunk
+            elif response.status == 200:
+                # The server ignored the `range` header, so skip to the part
+                # we want.
+                offset = 0
+                async for chunk in body:
+                    chunk_start = offset
+                    offset += len(chunk)
+                    if offset <= start:
+                        continue
+                    yield chunk[max(start - chunk_start, 0):end - chunk_start]
+                    if offset >= end:
+                        break
+            else:
+                raise ValueError(f"unexpected status {response.status} fetching range of {self.url}")
+        finally:
+            body.close()
 
 @dataclass
 class Response:
     """An HTTP response"""
     status: int
     headers: MutableMapping[str, str]
-    body: Optional[bytes]
+    """The response headers.
+
+    For responses returned by `send` or `send_async` this is a `Headers`
+    instance.  Handlers may return any mapping, e.g. a `dict`.
+    """
+    body: Optional[Union[Body, RangeSource]]
+    """The response body.
+
+    For responses returned by `send` or `send_async` this is a `bytearray`,
+    or a `spin_sdk.http.poll_loop.Stream` (or `DecodedStream`) if streaming
+    was requested.  Handlers may also return a `RangeSource`.
+    """
+
+@dataclass
+class Route:
+    """A handler registered with a `Router`."""
+    pattern: str
+    methods: Optional[FrozenSet[str]]
+    """The methods this route accepts, or `None` for any method."""
+    handler: Callable[..., Any]
+    """Called with the `Request` plus each path parameter as a keyword
+    argument.  This may be a coroutine function if the router is used from an
+    `AsyncIncomingHandler`."""
+    max_body_size: Optional[int] = None
+    """If set, overrides the handler's `max_request_body_size` for requests
+    matching this route."""
+
+class _Node:
+    __slots__ = ("children", "param", "param_node", "wildcard", "wildcard_routes", "routes")
+
+    def __init__(self):
+        self.children: Dict[str, _Node] = {}
+        self.param: Optional[str] = None
+        self.param_node: Optional[_Node] = None
+        self.wildcard: Optional[str] = None
+        self.wildcard_routes: List[Route] = []
+        self.routes: List[Route] = []
+
+class Router:
+    """Dispatches requests to handler functions based on method and path.
+
+    Route patterns are split into path segments, each of which is either a
+    literal, a `{name}` parameter matching any single segment, or (as the
+    last segment only) a `{*name}` wildcard matching the rest of the path.
+    Patterns are compiled into a trie as they are added, which typically
+    happens at import time and is thus captured when the component is
+    pre-initialized.  Literal segments take precedence over parameters, which
+    take precedence over wildcards; if the preferred branch leads to no
+    matching route, the next one is tried.  Dispatching a request usually
+    takes time proportional to the number of segments in its path.  When
+    literal and parameter routes overlap, it may have to backtrack.  Even so,
+    each trie node is visited at most once, so the worst case is bounded by
+    the size of the trie rather than being exponential.
+
+    ```python
+    router = http.Router()
+
+    @router.route("/users/{id}", methods=["GET"])
+    def get_user(request: Request, id: str) -> Response:
+        ...
+
+    class IncomingHandler(http.IncomingHandler):
+        router = router
+    ```
+
+    A route which accepts `GET` also accepts `HEAD`, unless another route
+    for the same pattern accepts `HEAD` explicitly.  A request whose path
+    matches no route gets a 404 response, and one whose path matches but
+    whose method doesn't gets a 405.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        # Whether any route sets `max_body_size`; if not, incoming handlers
+        # needn't match the request before dispatching it.
+        self._limits_body_size = False
+
+    def add(
+        self,
+        pattern: str,
+        handler: Callable[..., Any],
+        methods: Optional[Iterable[str]] = None,
+        max_body_size: Optional[int] = None
+    ) -> Route:
+        """Register `handler` for requests matching `pattern` and, if specified, `methods`.
+
+        See `Route.max_body_size` for the meaning of `max_body_size`.
+        """
+        route = Route(
+            pattern, frozenset(m.upper() for m in methods) if methods is not None else None, handler, max_body_size
+        )
+        if max_body_size is not None:
+            self._limits_body_size = True
+        node = self.root
+        segments = _segments(pattern)
+        for index, segment in enumerate(segments):
+            if segment.startswith("{*") and segment.endswith("}"):
+                if index != len(segments) - 1:
+                    raise ValueError(f"wildcard must be the last segment of {pattern!r}")
+                node.wildcard = _parameter_name(node.wildcard, segment[2:-1], pattern)
+                node.wildcard_routes.append(route)
+                return route
+            elif segment.startswith("{") and segment.endswith("}"):
+                node.param = _parameter_name(node.param, segment[1:-1], pattern)
+                if node.param_node is None:
+                    node.param_node = _Node()
+                node = node.param_node
+            else:
+                node = node.children.setdefault(segment, _Node())
+        node.routes.append(route)
+        return route
+
+    def route(
+        self,
+        pattern: str,
+        methods: Optional[Iterable[str]] = None,
+        max_body_size: Optional[int] = None
+    ) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+        """Decorator form of `add`."""
+        def decorator(handler: Callable[..., Any]) -> Callable[..., Any]:
+            self.add(pattern, handler, methods, max_body_size)
+            return handler
+        return decorator
+
+    def match(self, method: str, uri: str) -> Tuple[Optional[Route], Dict[str, str], Set[str]]:
+        """Find the route for the specified method and URI.
+
+        This returns the matching route (if any), the path parameters, and,
+        if the path matched but the method didn't, the set of methods which
+        would have matched.
+        """
+        path = uri.split("?", 1)[0]
+        segments = _segments(path)
+        params: Dict[str, str] = {}
+        allowed: Set[str] = set()
+        route = _match(self.root, segments, 0, method, params, allowed)
+        if route is None:
+            params.clear()
+        return route, params, allowed
+
+    def dispatch(self, request: Request) -> Response:
+        """Call the handler for `request` and return its response."""
+        route, params, allowed = self.match(request.method, request.uri)
+        if route is None:
+            return _no_route(allowed)
+        return route.handler(request, **params)
+
+    async def dispatch_async(self, request: Request) -> Response:
+        """Call the handler for `request`, awaiting it if it is a coroutine
+        function, and return its response."""
+        route, params, allowed = self.match(request.method, request.uri)
+        if route is None:
+            return _no_route(allowed)
+        response = route.handler(request, **params)
+        if inspect.isawaitable(response):
+            response = await response
+        return response
+
+def _segments(path: str) -> List[str]:
+    return [segment for segment in path.split("/") if segment]
+
+def _parameter_name(existing: Optional[str], name: str, pattern: str) -> str:
+    if not name.isidentifier():
+        raise ValueError(f"invalid parameter name {name!r} in {pattern!r}")
+    if existing is not None and existing != name:
+        raise ValueError(f"parameter {name!r} in {pattern!r} conflicts with previously registered {existing!r}")
+    return name
+
+def _select(routes: List[Route], method: str, allowed: Set[str]) -> Optional[Route]:
+    for route in routes:
+        if route.methods is None or method in route.methods:
+            return route
+    if method == "HEAD":
+        # Routes which allow `GET` also handle `HEAD`, unless another route
+        # handles it explicitly.
+        for route in routes:
+            if "GET" in cast(FrozenSet[str], route.methods):
+                return route
+    for route in routes:
+        if route.methods is not None:
+            allowed.update(route.methods)
+            if "GET" in route.methods:
+                allowed.add("HEAD")
+    return None
+
+def _match(
+    node: _Node, segments: List[str], index: int, method: str, params: Dict[str, str], allowed: Set[str]
+) -> Optional[Route]:
+    # Every node has exactly one parent and consumes exactly one segment, so
+    # it can only be reached at one `index` along one path: the search below
+    # visits each node at most once even when it backtracks.
+    if index == len(segments):
+        route = _select(node.routes, method, allowed)
+        if route is not None:
+            return route
+    else:
+        child = node.children.get(segments[index])
+        if child is not None:
+            route = _match(child, segments, index + 1, method, params, allowed)
+            if route is not None:
+                return route
+
+        if node.param_node is not None:
+            route = _match(node.param_node, segments, index + 1, method, params, allowed)
+            if route is not None:
+                params[cast(str, node.param)] = parse.unquote(segments[index])
+                return route
+
+    if node.wildcard_routes:
+        route = _select(node.wildcard_routes, method, allowed)
+        if route is not None:
+            params[cast(str, node.wildcard)] = parse.unquote("/".join(segments[index:]))
+            return route
+
+    return None
+
+def _no_route(allowed: Set[str]) -> Response:
+    if allowed:
+        return Response(
+            405,
+            {"content-type": "text/plain", "allow": ", ".join(sorted(allowed))},
+            b"Method Not Allowed"
+        )
+    else:
+        return Response(404, {"content-type": "text/plain"}, b"Not Found")
 
 try:
     from spin_sdk.wit import exports
     from spin_sdk.wit.exports import IncomingHandler as Base
     
-    class IncomingHandler(Base):
-        """Simplified handler for incoming HTTP requests using blocking, buffered I/O."""
+    class _IncomingHandlerBase(Base):
+        stream_request_body: bool = False
+        """Whether to pass the request body to `handle_request` unbuffered.
 
-        def handle_request(self, request: Request) -> Response:
-            """Handle an incoming HTTP request and return a response or raise an error"""
-            raise NotImplementedError
+        If `True`, `Request.body` will be a `spin_sdk.http.poll_loop.Stream`
+        yielding chunks as they arrive, so the handler can start work before
+        the whole body has been received and process it in constant memory.
+        Any part of the body left unread is discarded once the response has
+        been sent.
+        """
 
-        def handle(self, request: IncomingRequest, response_out: ResponseOutparam):
-            method = request.method()
-
-            if isinstance(method, Method_Get):
-                method_str = "GET"
-            elif isinstance(method, Method_Head):
-                method_str = "HEAD"
-            elif isinstance(method, Method_Post):
-                method_str = "POST"
-            elif isinstance(method, Method_Put):
-                method_str = "PUT"
-            elif isinstance(method, Method_Delete):
-                method_str = "DELETE"
-            elif isinstance(method, Method_Connect):
-                method_str = "CONNECT"
-            elif isinstance(method, Method_Options):
-                method_str = "OPTIONS"
-            elif isinstance(method, Method_Trace):
-                method_str = "TRACE"
-            elif isinstance(method, Method_Patch):
-                method_str = "PATCH"
-            elif isinstance(method, Method_Other):
-                method_str = method.value
-            else:
-                raise AssertionError
+        min_read_size: int = poll_loop.MIN_READ_SIZE
+        """Lower bound for the adaptive read size used by request body streams.
 
-            request_body = request.consume()
-            request_stream = request_body.stream()
-            body = bytearray()
-            while True:
-                try:
-                    body += request_stream.blocking_read(16 * 1024)
-                except Err as e:
-                    if isinstance(e.value, StreamError_Closed):
-                        request_stream.__exit__(None, None, None)
-                        IncomingBody.finish(request_body)
-                        break
-                    else:
-                        raise e
+        See `spin_sdk.http.poll_loop.Stream` for details.
+        """
+
+        max_read_size: int = poll_loop.MAX_READ_SIZE
+        """Upper bound for the adaptive read size used by request body streams.
+
+        See `spin_sdk.http.poll_loop.Stream` for details.
+        """
+
+        router: Optional[Router] = None
+        """If set, the default `handle_request` dispatches requests using this router."""
+
+        deadline: Optional[float] = None
+        """If set, the time budget in seconds for handling each request.
+
+        Outgoing requests made using `send` or `send_async` while handling a
+        request have their timeouts capped to whatever remains of this
+        budget, so a sequence of calls to slow dependencies can't together
+        take longer than this.  See also `remaining_time`.
+        """
+
+        max_request_body_size: Optional[int] = None
+        """If set, the maximum request body size in bytes.
+
+        A request whose `content-length` exceeds this is rejected with 413
+        (Content Too Large) before any of the body is read.  Otherwise, the
+        body stream raises `Err(ErrorCode_HttpRequestBodySize)` as soon as the
+        limit is crossed; if that propagates out of `handle_request` (as it
+        does when the body is buffered), a 413 response is sent.  A matching
+        route's `Route.max_body_size`, if any, takes precedence.
+        """
+
+        conditional_requests: bool = False
+        """Whether to answer conditional `GET` and `HEAD` requests with 304.
+
+        If `True`, a 200 response with a `bytes` body and no `etag` header is
+        given a strong ETag derived from a hash of the body; handlers with
+        streaming bodies (or a cheaper notion of version) may set `etag`
+        and/or `last-modified` themselves.  If the request's `if-none-match`
+        matches the ETag, or failing that its `if-modified-since` is no
+        earlier than `last-modified`, the body is discarded and an empty 304
+        (Not Modified) response is sent instead.
+        """
+
+        range_requests: bool = False
+        """Whether to answer `GET` requests with a `range` header with 206.
+
+        If `True`, responses whose length is known up front (i.e. `bytes`,
+        seekable file and `RangeSource` bodies) advertise `accept-ranges`, and
+        only the requested byte ranges are read and sent, as a
+        `multipart/byteranges` body if there are several.  `if-range` is
+        honoured using the response's `etag` or `last-modified` header, and
+        a range which lies beyond the end of the body yields a 416 (Range Not
+        Satisfiable) response.  Responses which `compression` applies to are
+        sent whole, without `accept-ranges`.
+        """
+
+        compression: bool = False
+        """Whether to compress response bodies for clients which accept it.
+
+        If `True`, the response body is compressed with gzip or deflate
+        according to the request's `accept-encoding` header.  Streaming bodies
+        are compressed incrementally as they are written.  Responses which
+        already have a `content-encoding`, whose `content-type` is already
+        compressed (e.g. images or archives), or whose length is known to be
+        less than `compression_min_size` are sent as-is.  `HEAD` responses get
+        the same headers as the corresponding `GET`, without `content-length`.
+        """
+
+        compression_min_size: int = 1024
+        """Minimum body size, in bytes, for `compression` to apply."""
+
+        compression_level: int = 6
+        """The `zlib` compression level (1-9) used by `compression`."""
+
+        def _prepare(self, request: Request, response: Response, asynchronous: bool) -> Response:
+            if not isinstance(response.headers, Headers):
+                response.headers = Headers._wrap(_header_entries(response.headers))
+            encoding = _compression_encoding(request, response, self.compression_min_size) \
+                if self.compression else None
+            if self.conditional_requests:
+                response = _conditional(request, response, encoding is not None)
+            if self.range_requests or isinstance(response.body, RangeSource):
+                # Byte ranges of the compressed body can't be served without
+                # compressing all of it first, and ranges of the uncompressed
+                # body would be spliced into the wrong representation by a
+                # client resuming a compressed download, so if the body is to
+                # be compressed only fetch its content.
+                response = _ranges(request, response, self.range_requests and encoding is None)
+            if encoding is not None:
+                response = _compress(
+                    response, encoding, self.compression_level, asynchronous, request.method == "HEAD"
+                )
+            return response
+
+        def _start_deadline(self) -> Optional[Token]:
+            if self.deadline is None:
+                return None
+            return _deadline.set(_now() + self.deadline)
+
+        def _body_limit(self, request: IncomingRequest) -> Optional[int]:
+            limit = self.max_request_body_size
+            if self.router is not None and self.router._limits_body_size:
+                route, _, _ = self.router.match(_method_name(request.method()), request.path_with_query() or "/")
+                if route is not None and route.max_body_size is not None:
+                    limit = route.max_body_size
+            return limit
+
+        def _stream(self, request: IncomingRequest, max_size: Optional[int]) -> Stream:
+            return Stream(
+                request.consume(),
+                min_read_size=self.min_read_size,
+                max_read_size=self.max_read_size,
+                max_size=max_size
+            )
+
+        def _request(self, request: IncomingRequest, headers: Headers, body: Union[bytearray, Stream]) -> Request:
+            method_str = _method_name(request.method())
 
             request_uri = request.path_with_query()
             if request_uri is None:
                 uri = "/"
             else:
                 uri = request_uri
-    
+
+            return Request(
+                method_str,
+                uri,
+                headers,
+                body
+            )
+
+        def _send_error(self, response_out: ResponseOutparam, status: int):
+            response = OutgoingResponse(Fields())
+            response.set_status_code(status)
+            ResponseOutparam.set(response_out, Ok(response))
+
+        def _send_head(self, simple_response: Response, response_out: ResponseOutparam) -> Sink:
+            if simple_response.headers.get('content-length') is None \
+               and simple_response.status not in (204, 304) and simple_response.status >= 200:
+                if simple_response.body is None:
+                    simple_response.headers['content-length'] = "0"
+                elif isinstance(simple_response.body, (bytes, bytearray, memoryview)):
+                    simple_response.headers['content-length'] = str(len(simple_response.body))
+
+            response = OutgoingResponse(Fields.from_list(_header_entries(simple_response.headers)))
+            response_body = response.body()
+            response.set_status_code(simple_response.status)
+            ResponseOutparam.set(response_out, Ok(response))
+            return Sink(response_body)
+
+    class IncomingHandler(_IncomingHandlerBase):
+        """Simplified handler for incoming HTTP requests using blocking, buffered I/O."""
+
+        def handle_request(self, request: Request) -> Response:
+            """Handle an incoming HTTP request and return a response or raise an error"""
+            if self.router is not None:
+                return self.router.dispatch(request)
+            raise NotImplementedError
+
+        def handle(self, request: IncomingRequest, response_out: ResponseOutparam):
+            token = self._start_deadline()
             try:
-                simple_response = self.handle_request(Request(
-                    method_str,
-                    uri,
-                    dict(map(lambda pair: (pair[0], str(pair[1], "utf-8")), request.headers().entries())),
-                    bytes(body)
-                ))
+                self._handle(request, response_out)
+            finally:
+                if token is not None:
+                    _deadline.reset(token)
+                poll_loop.reset()
+
+        def _handle(self, request: IncomingRequest, response_out: ResponseOutparam):
+            headers = Headers._wrap(request.headers().entries())
+            content_length = _content_length(headers)
+            max_size = self._body_limit(request)
+            if max_size is not None and content_length is not None and content_length > max_size:
+                self._send_error(response_out, 413)
+                return
+
+            request_stream = self._stream(request, max_size)
+            try:
+                body: Union[bytearray, Stream]
+                if self.stream_request_body:
+                    body = request_stream
+                else:
+                    body = read_body_blocking(request_stream, content_length)
+
+                simple_request = self._request(request, headers, body)
+                simple_response = self._prepare(simple_request, self.handle_request(simple_request), False)
+            except BaseException as e:
+                request_stream.close()
+                if _body_too_large(e):
+                    self._send_error(response_out, 413)
+                else:
+                    traceback.print_exc()
+                    self._send_error(response_out, 500)
+                return
+
+            sink = self._send_head(simple_response, response_out)
+            # `_prepare` has replaced any `RangeSource` body with its content.
+            response_body = cast(Optional[Body], simple_response.body)
+            try:
+                if simple_request.method == "HEAD":
+                    # The response has no content, so don't produce any.
+                    if hasattr(response_body, "aclose"):
+                        poll_loop.run(_aclose(response_body))
+                    else:
+                        _close(response_body)
+                else:
+                    write_body_blocking(sink, response_body)
             except:
+                # The status and headers have already been sent, so all we can
+                # do is signal to the client that the body is incomplete.
                 traceback.print_exc()
-    
-                response = OutgoingResponse(Fields())
-                response.set_status_code(500)
-                ResponseOutparam.set(response_out, Ok(response))
+                sink.abort()
+            else:
+                sink.close()
+            request_stream.close()
+
+    class AsyncIncomingHandler(_IncomingHandlerBase):
+        """Simplified handler for incoming HTTP requests using asynchronous I/O.
+
+        Each request is handled by running `handle_request` to completion on
+        the instance's `PollLoop` (see `spin_sdk.http.poll_loop.get_loop`), so
+        the handler may use `send_async` together with e.g. `asyncio.gather`
+        to make several outbound requests concurrently.  Any tasks the handler
+        leaves running are cancelled once the response has been sent (see
+        `spin_sdk.http.poll_loop.reset`).
+        """
+
+        async def handle_request(self, request: Request) -> Response:
+            """Handle an incoming HTTP request and return a response or raise an error"""
+            if self.router is not None:
+                return await self.router.dispatch_async(request)
+            raise NotImplementedError
+
+        def handle(self, request: IncomingRequest, response_out: ResponseOutparam):
+            token = self._start_deadline()
+            try:
+                poll_loop.run(self._handle_async(request, response_out))
+            finally:
+                if token is not None:
+                    _deadline.reset(token)
+                poll_loop.reset()
+
+        async def _handle_async(self, request: IncomingRequest, response_out: ResponseOutparam):
+            headers = Headers._wrap(request.headers().entries())
+            content_length = _content_length(headers)
+            max_size = self._body_limit(request)
+            if max_size is not None and content_length is not None and content_length > max_size:
+                self._send_error(response_out, 413)
                 return
 
-            if simple_response.headers.get('content-length') is None:
-                content_length = len(simple_response.body) if simple_response.body is not None else 0
-                simple_response.headers['content-length'] = str(content_length)
+            request_stream = self._stream(request, max_size)
+            try:
+                body: Union[bytearray, Stream]
+                if self.stream_request_body:
+                    body = request_stream
+                else:
+                    body = await read_body(request_stream, content_length)
+
+                simple_request = self._request(request, headers, body)
+                simple_response = self._prepare(simple_request, await self.handle_request(simple_request), True)
+            except BaseException as e:
+                request_stream.close()
+                if _body_too_large(e):
+                    self._send_error(response_out, 413)
+                else:
+                    traceback.print_exc()
+                    self._send_error(response_out, 500)
+                return
 
-            response = OutgoingResponse(Fields.from_list(list(map(
-                lambda pair: (pair[0], bytes(pair[1], "utf-8")),
-                simple_response.headers.items()
-            ))))
-            response_body = response.body()
-            response.set_status_code(simple_response.status)
-            ResponseOutparam.set(response_out, Ok(response))
-            response_stream = response_body.write()
-            if simple_response.body is not None:
-                MAX_BLOCKING_WRITE_SIZE = 4096
-                offset = 0
-                while offset < len(simple_response.body):
-                    count = min(len(simple_response.body) - offset, MAX_BLOCKING_WRITE_SIZE)
-                    response_stream.blocking_write_and_flush(simple_response.body[offset:offset+count])
-                    offset += count
-            response_stream.__exit__(None, None, None)
-            OutgoingBody.finish(response_body, None)
+            sink = self._send_head(simple_response, response_out)
+            # `_prepare` has replaced any `RangeSource` body with its content.
+            response_body = cast(Optional[Body], simple_response.body)
+            try:
+                if simple_request.method == "HEAD":
+                    # The response has no content, so don't produce any.
+                    await _aclose(response_body)
+                else:
+                    await write_body(sink, response_body)
+            except:
+                # The status and headers have already been sent, so all we can
+                # do is signal to the client that the body is incomplete.
+                traceback.print_exc()
+                sink.abort()
+            else:
+                sink.close()
+            request_stream.close()
 
 except ImportError:
     # `spin_sdk.wit.exports` won't exist if the use is targeting `spin-imports`,
     # so just skip this part
     pass
 
-def send(request: Request) -> Response:
-    """Send an HTTP request and return a response or raise an error"""
-    loop = PollLoop()
-    asyncio.set_event_loop(loop)
-    return loop.run_until_complete(send_async(request))
-    
+# Content codings which `send_async` knows how to decode, mapped to the `zlib`
+# window bits to use: 47 detects either gzip or zlib framing.
+_CONTENT_CODINGS = {"gzip": 47, "x-gzip": 47, "deflate": 47}
+
+class DecodedStream:
+    """A response body which is decompressed as it is read.
+
+    This wraps a `spin_sdk.http.poll_loop.Stream` of gzip- or
+    deflate-encoded data and, like `Stream`, may be consumed using `next`,
+    `blocking_next`, `async for` or a plain `for` loop.  Each call decodes
+    only the data read so far, so memory use doesn't depend on the size of
+    the whole body.  Corrupt data raises
+    `Err(ErrorCode_HttpResponseContentCoding(encoding))`.
+
+    If `max_size` is specified, `Err(ErrorCode_HttpResponseBodySize)` is
+    raised once more than that many bytes have been decoded, which guards
+    against small bodies which decompress to huge ones.
+    """
+    def __init__(self, stream: Stream, encoding: str, max_size: Optional[int] = None):
+        self.stream = stream
+        self.max_size = max_size
+        self.bytes_decoded = 0
+        self.encoding = encoding
+        self.decompressor = zlib.decompressobj(_CONTENT_CODINGS[encoding])
+        # Compressed input seen before any output was produced, kept in case
+        # the server sent raw deflate data without the zlib header:
+        self.head: Optional[bytearray] = bytearray() if encoding == "deflate" else None
+        self.started = False
+        self.done = False
+
+    async def next(self) -> Optional[bytes]:
+        """Wait for the next chunk of decoded data.
+
+        This will return `None` when the end of the stream has been reached.
+        """
+        while True:
+            chunk = self._pending()
+            if chunk:
+                return chunk
+            if self.done:
+                return None
+            chunk = self._decode(await self.stream.next())
+            if chunk:
+                return chunk
+
+    def blocking_next(self) -> Optional[bytes]:
+        """Block until the next chunk of decoded data is available.
+
+        This will return `None` when the end of the stream has been reached.
+        """
+        while True:
+            chunk = self._pending()
+            if chunk:
+                return chunk
+            if self.done:
+                return None
+            chunk = self._decode(self.stream.blocking_next())
+            if chunk:
+                return chunk
+
+    def _pending(self) -> bytes:
+        # Output held back by the limit in `_decode`:
+        tail = self.decompressor.unconsumed_tail
+        if not tail:
+            return b""
+        return self._decompress(tail)
+
+    def _decode(self, chunk: Optional[bytes]) -> bytes:
+        if chunk is None:
+            self.done = True
+            try:
+                output = self.decompressor.flush()
+            except zlib.error:
+                output = None
+            finally:
+                self.stream.close()
+            # An empty body (e.g. in response to `HEAD`) is fine, but a
+            # truncated one isn't:
+            if output is None or (self.started and not self.decompressor.eof):
+                raise Err(ErrorCode_HttpResponseContentCoding(self.encoding))
+            return self._count(output)
+
+        self.started = True
+        if self.head is not None:
+            self.head += chunk
+        return self._decompress(chunk)
+
+    def _decompress(self, data: bytes) -> bytes:
+        try:
+            # Bound the output per call so a small, highly compressed chunk
+            # can't expand into one huge allocation:
+            output = self.decompressor.decompress(data, poll_loop.MAX_READ_SIZE)
+        except zlib.error:
+            if self.head is None:
+                self.close()
+                raise Err(ErrorCode_HttpResponseContentCoding(self.encoding))
+            head = bytes(self.head)
+            self.head = None
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decompress(head)
+
+        if output:
+            self.head = None
+        return self._count(output)
+
+    def _count(self, output: bytes) -> bytes:
+        self.bytes_decoded += len(output)
+        if self.max_size is not None and self.bytes_decoded > self.max_size:
+            self.close()
+            raise Err(ErrorCode_HttpResponseBodySize(self.bytes_decoded))
+        return output
+
+    def close(self):
+        """Release the underlying stream, discarding any unread data."""
+        self.done = True
+        self.stream.close()
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self
+
+    def __next__(self) -> bytes:
+        chunk = self.blocking_next()
+        if chunk is None:
+            raise StopIteration
+        return chunk
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self
+
+    async def __anext__(self) -> bytes:
+        chunk = await self.next()
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+@dataclass
+class Timeouts:
+    """Timeouts for an outgoing request, in seconds.
+
+    `None` means no limit beyond any imposed by the host.  `connect`,
+    `first_byte` and `between_bytes` are passed to the host as
+    `wasi:http/types#request-options`.
+    """
+    connect: Optional[float] = None
+    """Maximum time to establish a connection."""
+    first_byte: Optional[float] = None
+    """Maximum time from sending the request to receiving the first byte of
+    the response."""
+    between_bytes: Optional[float] = None
+    """Maximum time between receiving consecutive chunks of the response body."""
+    total: Optional[float] = None
+    """Maximum time for the whole exchange, i.e. until the response (and,
+    unless it is streamed, its body) has been received."""
+
+DEFAULT_TIMEOUTS: Timeouts = Timeouts()
+"""Timeouts used by `send` and `send_async` where not overridden per request."""
+
+# Absolute time (per `_now`) by which the current incoming request should be
+# handled; see `IncomingHandler.deadline`.
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+def _now() -> float:
+    return monotonic_clock.now() / 1e9
+
+def remaining_time() -> Optional[float]:
+    """Return the number of seconds left before the current incoming
+    request's deadline, or `None` if it has none.
+
+    See `IncomingHandler.deadline`.
+    """
+    deadline = _deadline.get()
+    return None if deadline is None else max(deadline - _now(), 0.0)
 
-async def send_async(request: Request) -> Response:
-    match request.method:
-        case "GET":
-            method: Method = Method_Get()
-        case "HEAD":
-            method = Method_Head()
-        case "POST":
-            method = Method_Post()
-        case "PUT":
-            method = Method_Put()
-        case "DELETE":
-            method = Method_Delete()
-        case "CONNECT":
-            method = Method_Connect()
-        case "OPTIONS":
-            method = Method_Options()
-        case "TRACE":
-            method = Method_Trace()
-        case "PATCH":
-            method = Method_Patch()
-        case _:
-            method = Method_Other(request.method)
+def _effective_timeouts(timeouts: Optional[Timeouts]) -> Timeouts:
+    # Fill in defaults, then cap everything to the remaining budget.
+    values = {}
+    remaining = remaining_time()
+    for field in dataclass_fields(Timeouts):
+        value = getattr(timeouts, field.name) if timeouts is not None else None
+        if value is None:
+            value = getattr(DEFAULT_TIMEOUTS, field.name)
+        if remaining is not None:
+            value = remaining if value is None else min(value, remaining)
+        values[field.name] = value
+    return Timeouts(**values)
+
+def _request_options(timeouts: Timeouts) -> Optional[RequestOptions]:
+    if timeouts.connect is None and timeouts.first_byte is None and timeouts.between_bytes is None:
+        return None
+    options = RequestOptions()
+    for value, setter in (
+        (timeouts.connect, options.set_connect_timeout),
+        (timeouts.first_byte, options.set_first_byte_timeout),
+        (timeouts.between_bytes, options.set_between_bytes_timeout)
+    ):
+        if value is not None:
+            try:
+                setter(math.ceil(value * 1e9))
+            except Err:
+                # The host doesn't support this option; `total` still applies.
+                pass
+    return options
+
+# Errors which mean the request never reached the server, so it may be
+# retried whatever its method.
+_UNSENT_ERRORS = (ErrorCode_DnsTimeout, ErrorCode_DestinationUnavailable, ErrorCode_ConnectionRefused)
+
+@dataclass
+class RetryPolicy:
+    """When and how often `send` and `send_async` retry a failed request.
+
+    A request is retried if it fails with one of `error_codes` or gets a
+    response with one of `statuses`, up to `max_attempts` attempts in total.
+    Only requests with one of the (idempotent) `methods` or an
+    `idempotency-key` header are retried, except after errors which show the
+    request never reached the server (e.g. a refused connection).  Requests
+    whose body isn't `bytes` (or `None`) are never retried, since their body
+    can't be replayed.
+
+    Before attempt `n + 1`, the sender waits a random time of up to
+    `min(max_backoff, backoff * multiplier ** (n - 1))` seconds ("full
+    jitter"), or longer if the response has a `retry-after` header.  It gives
+    up, returning the last response or raising the last error, if
+    `retry-after` asks for more than `max_backoff`, if the wait would take
+    the time since the first attempt past `budget`, or if it would pass the
+    current incoming request's deadline.  Waiting uses `asyncio.sleep`, so
+    other tasks keep running meanwhile.
+    """
+    max_attempts: int = 3
+    statuses: FrozenSet[int] = frozenset([429, 502, 503, 504])
+    error_codes: Tuple[type, ...] = (
+        ErrorCode_DnsTimeout, ErrorCode_DestinationUnavailable, ErrorCode_ConnectionRefused,
+        ErrorCode_ConnectionTerminated, ErrorCode_ConnectionTimeout, ErrorCode_ConnectionReadTimeout,
+        ErrorCode_ConnectionWriteTimeout, ErrorCode_ConnectionLimitReached, ErrorCode_HttpResponseIncomplete
+    )
+    methods: FrozenSet[str] = frozenset(["GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE"])
+    backoff: float = 0.1
+    multiplier: float = 2.0
+    max_backoff: float = 5.0
+    budget: Optional[float] = None
+
+    def _delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * self.multiplier ** (attempt - 1)))
+
+def _idempotent(request: Request, retry: RetryPolicy) -> bool:
+    return request.method.upper() in retry.methods \
+        or any(name.lower() == "idempotency-key" for name in request.headers.keys())
+
+def _retry_after(headers: Headers) -> Optional[float]:
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max((utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def send(
+    request: Request,
+    *,
+    stream: bool = False,
+    decompress: bool = True,
+    max_response_body_size: Optional[int] = None,
+    timeouts: Optional[Timeouts] = None,
+    retry: Optional[RetryPolicy] = None
+) -> Response:
+    """Send an HTTP request and return a response or raise an error
+
+    See `send_async` for a description of the keyword parameters; a streamed
+    body may be read here using a (blocking) `for` loop.  This may also be
+    called from synchronous code running on a `PollLoop`, e.g. a helper
+    called from `AsyncIncomingHandler.handle_request`, in which case it runs
+    that loop rather than creating a new one.
+    """
+    return poll_loop.run(send_async(
+        request,
+        stream=stream,
+        decompress=decompress,
+        max_response_body_size=max_response_body_size,
+        timeouts=timeouts,
+        retry=retry
+    ))
     
-    url_parsed = parse.urlparse(request.uri)
 
-    match url_parsed.scheme:
-        case "http":
-            scheme: Scheme = Scheme_Http()
-        case "https":
-            scheme = Scheme_Https()
-        case "":
-            scheme = Scheme_Http()
-        case _:
-            scheme = Scheme_Other(url_parsed.scheme)
+async def send_async(
+    request: Request,
+    *,
+    stream: bool = False,
+    decompress: bool = True,
+    max_response_body_size: Optional[int] = None,
+    timeouts: Optional[Timeouts] = None,
+    retry: Optional[RetryPolicy] = None
+) -> Response:
+    """Send an HTTP request and return a response or raise an error.
+
+    This must be awaited on a running `PollLoop`, e.g. from
+    `AsyncIncomingHandler.handle_request`.  It may be cancelled (e.g. using
+    `asyncio.wait_for`), in which case the request and any part of the
+    response received so far are released immediately.
+
+    By default, the whole response body is read before returning.  If
+    `stream` is `True`, this returns as soon as the status and headers have
+    arrived, and the body is a `spin_sdk.http.poll_loop.Stream` yielding
+    chunks as they arrive.  The caller should either read it to the end or
+    `close` it.  Such a response may be returned as-is from a handler to
+    forward the body to the client as it arrives.
+
+    If `decompress` is `True` and the request has no `accept-encoding`
+    header, one advertising gzip and deflate is added.  A response encoded
+    with either is then decoded as it is read, and its `content-encoding` and
+    `content-length` headers are removed; a streamed body is a
+    `DecodedStream` in that case.  Pass `decompress=False` to receive the
+    body exactly as sent.
+
+    If `max_response_body_size` is specified, a response body larger than
+    that many bytes (after decoding, if applicable) raises
+    `Err(ErrorCode_HttpResponseBodySize)`: immediately if its
+    `content-length` says so, otherwise as soon as the limit is crossed while
+    reading it, so no more than that is ever buffered.
+
+    `timeouts` override `DEFAULT_TIMEOUTS` field by field, and all of them
+    are capped to the time left before the current incoming request's
+    deadline, if any (see `IncomingHandler.deadline`).  Exceeding the `total`
+    timeout (or the deadline) raises `Err(ErrorCode_HttpResponseTimeout())`;
+    the others are enforced by the host, which reports its own error codes.
+    Timeouts apply to each attempt separately.
+
+    If `retry` is specified, failed requests are retried as described by
+    `RetryPolicy`.
+    """
+    if retry is None or not (request.body is None or isinstance(request.body, (bytes, bytearray, memoryview))):
+        return await _send_with_timeouts(request, stream, decompress, max_response_body_size, timeouts)
+
+    idempotent = _idempotent(request, retry)
+    started = _now()
+    attempt = 1
+    while True:
+        response: Optional[Response] = None
+        try:
+            response = await _send_with_timeouts(request, stream, decompress, max_response_body_size, timeouts)
+        except Err as e:
+            retryable = isinstance(e.value, retry.error_codes) \
+                and (idempotent or isinstance(e.value, _UNSENT_ERRORS))
+            if not retryable or attempt >= retry.max_attempts:
+                raise
+            wait = retry._delay(attempt)
+            error: Optional[Err] = e
+        else:
+            if response.status not in retry.statuses or not idempotent or attempt >= retry.max_attempts:
+                return response
+            wait = retry._delay(attempt)
+            retry_after = _retry_after(cast(Headers, response.headers))
+            if retry_after is not None:
+                if retry_after > retry.max_backoff:
+                    return response
+                wait = max(wait, retry_after)
+            error = None
+
+        remaining = remaining_time()
+        if (retry.budget is not None and _now() + wait - started > retry.budget) \
+           or (remaining is not None and wait >= remaining):
+            if error is not None:
+                raise error
+            return cast(Response, response)
+
+        if response is not None:
+            _close(response.body)
+        await asyncio.sleep(wait)
+        attempt += 1
+
+async def _send_with_timeouts(
+    request: Request,
+    stream: bool,
+    decompress: bool,
+    max_response_body_size: Optional[int],
+    timeouts: Optional[Timeouts]
+) -> Response:
+    effective = _effective_timeouts(timeouts)
+    if effective.total is None:
+        return await _send_async(request, stream, decompress, max_response_body_size, effective)
+
+    if effective.total <= 0:
+        raise Err(ErrorCode_HttpResponseTimeout())
+    try:
+        async with asyncio.timeout(effective.total):
+            return await _send_async(request, stream, decompress, max_response_body_size, effective)
+    except TimeoutError:
+        raise Err(ErrorCode_HttpResponseTimeout())
+
+async def _send_async(
+    request: Request,
+    stream: bool,
+    decompress: bool,
+    max_response_body_size: Optional[int],
+    timeouts: Timeouts
+) -> Response:
+    method = _method_from_name(request.method)
+    url_parsed = parse.urlparse(request.uri)
+    scheme = _scheme_from_name(url_parsed.scheme)
 
     headers_dict = request.headers
 
-    # Add a `content-length` header if the caller didn't include one, but did
-    # specify a body:
-    if headers_dict.get('content-length') is None:
-        content_length = len(request.body) if request.body is not None else 0
+    # Add a `content-length` header if the caller didn't include one and the
+    # body's length is known up front; other bodies are sent chunked:
+    if headers_dict.get('content-length') is None \
+       and (request.body is None or isinstance(request.body, (bytes, bytearray, memoryview))):
+        request_content_length = len(request.body) if request.body is not None else 0
         # Make a copy rather than mutate in place, since the caller might not
         # expect us to mutate it:
         headers_dict = headers_dict.copy()
-        headers_dict['content-length'] = str(content_length)
+        headers_dict['content-length'] = str(request_content_length)
 
-    headers = list(map(
-        lambda pair: (pair[0], bytes(pair[1], "utf-8")),
-        headers_dict.items()
-    ))
+    if decompress and headers_dict.get('accept-encoding') is None:
+        if headers_dict is request.headers:
+            headers_dict = headers_dict.copy()
+        headers_dict['accept-encoding'] = "gzip, deflate"
 
-    outgoing_request = OutgoingRequest(Fields.from_list(headers))
+    outgoing_request = OutgoingRequest(Fields.from_list(_header_entries(headers_dict)))
     outgoing_request.set_method(method)
     outgoing_request.set_scheme(scheme)
     if url_parsed.netloc == '':
-        if scheme == "http":
+        if isinstance(scheme, Scheme_Http):
             authority = ":80"
         else:
             authority = ":443"
@@ -206,33 +1239,831 @@ async def send_async(request: Request) -> Response:
         path_and_query += '?' + url_parsed.query
     outgoing_request.set_path_with_query(path_and_query)
 
-    outgoing_body = request.body if request.body is not None else bytearray()
     sink = Sink(outgoing_request.body())
-    incoming_response: IncomingResponse = (await asyncio.gather(
-        poll_loop.send(outgoing_request),
-        send_and_close(sink, outgoing_body)
-    ))[0]
+    sending = asyncio.ensure_future(poll_loop.send(outgoing_request, _request_options(timeouts)))
+    writing = asyncio.ensure_future(send_and_close(sink, request.body))
+    try:
+        incoming_response: IncomingResponse = (await asyncio.gather(sending, writing))[0]
+    except BaseException:
+        # Whether this task was cancelled or one side failed, abandon the
+        # other rather than leaving it running, and release the response if
+        # it already arrived.  Wait for the cancellations to take effect so
+        # that each task releases its pollables and streams before we return.
+        sending.cancel()
+        writing.cancel()
+        await asyncio.gather(sending, writing, return_exceptions=True)
+        if not sending.cancelled() and sending.exception() is None:
+            sending.result().__exit__(None, None, None)
+        raise
 
-    response_body = Stream(incoming_response.consume())
-    body = bytearray()
-    while True:
-        chunk = await response_body.next()
-        if chunk is None:
-            headers = incoming_response.headers()
-            simple_response = Response(
-                incoming_response.status(),
-                dict(map(
-                    lambda pair: (pair[0], str(pair[1], "utf-8")),
-                    headers.entries()
-                )),
-                bytes(body)
-            )
-            headers.__exit__(None, None, None)
-            incoming_response.__exit__(None, None, None)
-            return simple_response
+    fields = incoming_response.headers()
+    response_headers = Headers._wrap(fields.entries())
+    fields.__exit__(None, None, None)
+
+    content_length = _content_length(response_headers)
+    if max_response_body_size is not None and content_length is not None \
+       and content_length > max_response_body_size:
+        incoming_response.__exit__(None, None, None)
+        raise Err(ErrorCode_HttpResponseBodySize(content_length))
+
+    encoding = None
+    if decompress:
+        encoding = response_headers.get("content-encoding", "").strip().lower()
+        if encoding in _CONTENT_CODINGS:
+            del response_headers["content-encoding"]
+            if "content-length" in response_headers:
+                del response_headers["content-length"]
+        else:
+            encoding = None
+
+    # The response resource is released along with the body once the latter
+    # has been read to the end or closed.
+    status = incoming_response.status()
+    body_stream = Stream(incoming_response.consume(), incoming_response, max_size=max_response_body_size)
+    decoded = None if encoding is None else DecodedStream(body_stream, encoding, max_response_body_size)
+
+    if stream:
+        return Response(status, response_headers, body_stream if decoded is None else decoded)
+
+    try:
+        if decoded is not None:
+            buffer = bytearray()
+            while True:
+                chunk = await decoded.next()
+                if chunk is None:
+                    break
+                buffer += chunk
+            body = buffer
         else:
-            body += chunk
+            body = await read_body(body_stream, content_length)
+    finally:
+        body_stream.close()
+    return Response(status, response_headers, body)
+
+# Headers which apply to a single connection and must not be forwarded by a
+# proxy, plus those which `wasi:http` doesn't allow guests to set.
+_HOP_BY_HOP_HEADERS = frozenset([
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "proxy-connection",
+    "te", "trailer", "transfer-encoding", "upgrade", "host", "http2-settings"
+])
+
+def proxy(request: Request, origin: str) -> Response:
+    """Forward `request` to `origin` and return the upstream response.
+
+    See `proxy_async` for details.
+    """
+    return poll_loop.run(proxy_async(request, origin))
+
+async def proxy_async(request: Request, origin: str) -> Response:
+    """Forward `request` to `origin` and return the upstream response.
+
+    `origin` is a URL such as `https://backend.example.com` (optionally with a
+    path prefix) to which the request's path and query are appended.
+    Hop-by-hop headers are dropped in both directions.
+
+    The upstream response body is streamed, so returning the result from a
+    handler relays it to the client as it arrives.  If the handler also sets
+    `stream_request_body`, the request body is relayed the same way.  Either
+    way, `Stream` bodies are spliced by the host rather than copied through
+    Python.
+    """
+    headers = Headers._wrap([
+        (name, value) for name, value in _header_entries(request.headers)
+        if name.lower() not in _HOP_BY_HOP_HEADERS
+    ])
+    response = await send_async(
+        Request(request.method, origin.rstrip("/") + request.uri, headers, request.body),
+        stream=True,
+        decompress=False
+    )
+    for name in list(response.headers.keys()):
+        if name.lower() in _HOP_BY_HOP_HEADERS:
+            del response.headers[name]
+    return response
+
+def send_many(
+    requests: Iterable[Request],
+    *,
+    max_concurrency: Optional[int] = None,
+    per_host_limit: Optional[int] = None,
+    return_exceptions: bool = False,
+    stream: bool = False,
+    decompress: bool = True,
+    max_response_body_size: Optional[int] = None,
+    timeouts: Optional[Timeouts] = None,
+    retry: Optional[RetryPolicy] = None
+) -> Iterator[Tuple[Request, Union[Response, BaseException]]]:
+    """Send several HTTP requests concurrently, yielding `(request, response)`
+    pairs in the order in which the responses complete.
+
+    See `send_many_async` for a description of the parameters.
+    """
+    responses = send_many_async(
+        requests,
+        max_concurrency=max_concurrency,
+        per_host_limit=per_host_limit,
+        return_exceptions=return_exceptions,
+        stream=stream,
+        decompress=decompress,
+        max_response_body_size=max_response_body_size,
+        timeouts=timeouts,
+        retry=retry
+    )
+    try:
+        while True:
+            try:
+                yield poll_loop.run(responses.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        poll_loop.run(responses.aclose())
+
+async def send_many_async(
+    requests: Iterable[Request],
+    *,
+    max_concurrency: Optional[int] = None,
+    per_host_limit: Optional[int] = None,
+    return_exceptions: bool = False,
+    stream: bool = False,
+    decompress: bool = True,
+    max_response_body_size: Optional[int] = None,
+    timeouts: Optional[Timeouts] = None,
+    retry: Optional[RetryPolicy] = None
+) -> AsyncGenerator[Tuple[Request, Union[Response, BaseException]], None]:
+    """Send several HTTP requests concurrently, yielding `(request, response)`
+    pairs in the order in which the responses complete.
+
+    At most `max_concurrency` requests are in flight at any time, and at most
+    `per_host_limit` of those may target the same authority; `None` means no
+    limit.  Requests are taken from `requests` lazily as capacity becomes
+    available, so it may be a generator.
+
+    By default, the first error raised while sending a request is propagated
+    and all other in-flight requests are cancelled.  If `return_exceptions` is
+    `True`, the exception is yielded in place of the response instead.
+
+    The remaining keyword parameters apply to each request; see
+    `send_async`.
+    """
+    pending = iter(requests)
+    exhausted = False
+    # Requests taken from `pending` which are waiting for their host to drop
+    # below `per_host_limit`, keyed by authority
+    waiting: Dict[str, Deque[Request]] = {}
+    waiting_count = 0
+    in_flight_per_host: Dict[str, int] = {}
+    tasks: Dict[asyncio.Future, Tuple[str, Request]] = {}
+
+    def has_capacity() -> bool:
+        return max_concurrency is None or len(tasks) < max_concurrency
+
+    def host_has_capacity(host: str) -> bool:
+        return per_host_limit is None or in_flight_per_host.get(host, 0) < per_host_limit
+
+    def start(host: str, request: Request):
+        in_flight_per_host[host] = in_flight_per_host.get(host, 0) + 1
+        tasks[asyncio.ensure_future(send_async(
+            request,
+            stream=stream,
+            decompress=decompress,
+            max_response_body_size=max_response_body_size,
+            timeouts=timeouts,
+            retry=retry
+        ))] = (host, request)
+
+    def fill():
+        nonlocal exhausted, waiting_count
+
+        for host, queue in waiting.items():
+            while queue and has_capacity() and host_has_capacity(host):
+                start(host, queue.popleft())
+                waiting_count -= 1
+
+        # Bound how far ahead of the in-flight requests we read so that a
+        # single saturated host can't make us buffer the whole input.
+        while not exhausted and has_capacity() \
+              and (max_concurrency is None or waiting_count < max_concurrency):
+            try:
+                request = next(pending)
+            except StopIteration:
+                exhausted = True
+                break
 
-async def send_and_close(sink: Sink, data: bytes):
-    await sink.send(data)
+            host = parse.urlparse(request.uri).netloc
+            if host_has_capacity(host):
+                start(host, request)
+            else:
+                waiting.setdefault(host, deque()).append(request)
+                waiting_count += 1
+
+    try:
+        fill()
+        while tasks:
+            done, _ = await asyncio.wait(tasks.keys(), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                host, request = tasks.pop(task)
+                in_flight_per_host[host] -= 1
+                exception = task.exception()
+                if exception is None:
+                    yield request, task.result()
+                elif return_exceptions:
+                    yield request, exception
+                else:
+                    raise exception
+            fill()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            # Let the cancelled requests release their resources.  This also
+            # retrieves any errors besides the first, which is propagated, so
+            # they aren't reported to the loop.
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in results:
+                # A request may have completed without its response being
+                # yielded, e.g. alongside the one whose error is propagated.
+                if isinstance(result, Response):
+                    _close(result.body)
+
+async def send_and_close(sink: Sink, data: Optional[Body]):
+    try:
+        await write_body(sink, data)
+    except:
+        sink.abort()
+        raise
     sink.close()
+
+# Headers which a 304 response may carry (RFC 9110, section 15.4.5), plus
+# `last-modified`, which caches use to update their stored response.
+_NOT_MODIFIED_HEADERS = frozenset([
+    "cache-control", "content-location", "date", "etag", "expires", "vary", "last-modified"
+])
+
+def _conditional(request: Request, response: Response, compressed: bool) -> Response:
+    headers = cast(Headers, response.headers)
+    if request.method not in ("GET", "HEAD") or response.status != 200:
+        return response
+
+    etag = headers.get("etag")
+    if etag is None and isinstance(response.body, (bytes, bytearray, memoryview)):
+        etag = '"' + hashlib.blake2b(response.body, digest_size=16).hexdigest() + '"'
+        headers["etag"] = etag
+    if compressed:
+        # A 304 must carry the validator and `vary` the 200 would have had.
+        _mark_compressed(headers)
+
+    request_headers = request.headers if isinstance(request.headers, Headers) \
+        else Headers._wrap(_header_entries(request.headers))
+    if_none_match = request_headers.get_all("if-none-match")
+    if if_none_match:
+        not_modified = etag is not None and _etag_matches(", ".join(if_none_match), etag)
+    else:
+        not_modified = _not_modified_since(request_headers.get("if-modified-since"), headers.get("last-modified"))
+
+    if not not_modified:
+        return response
+
+    _close(response.body)
+    for name in list(headers.keys()):
+        if name.lower() not in _NOT_MODIFIED_HEADERS:
+            del headers[name]
+    return Response(304, headers, None)
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # `if-none-match` uses the weak comparison function, i.e. `W/` prefixes
+    # are ignored.
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.strip().removeprefix("W/")
+    return any(
+        candidate.strip().removeprefix("W/") == etag
+        for candidate in if_none_match.split(",")
+    )
+
+def _not_modified_since(if_modified_since: Optional[str], last_modified: Optional[str]) -> bool:
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        return utils.parsedate_to_datetime(last_modified) <= utils.parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        # Invalid dates are ignored, per RFC 9110.
+        return False
+
+# More ranges than this in one request are assumed to be an attempt to waste
+# resources, and the whole body is sent instead.
+_MAX_RANGES = 32
+
+def _ranges(request: Request, response: Response, enabled: bool) -> Response:
+    headers = cast(Headers, response.headers)
+    body = response.body
+
+    read: Callable[[int, int], Body]
+    if isinstance(body, RangeSource):
+        size = body.size
+        read = body.read_range
+    elif isinstance(body, (bytes, bytearray, memoryview)):
+        size = len(body)
+        data = memoryview(body)
+        read = lambda start, end: bytes(data[start:end])
+    elif hasattr(body, "seek") and getattr(body, "seekable", lambda: False)():
+        file = cast(BinaryIO, body)
+        base = file.tell()
+        size = file.seek(0, 2) - base
+        file.seek(base)
+        read = lambda start, end: _file_range(file, base + start, end - start)
+    else:
+        return response
+
+    ranges = None
+    if enabled and response.status == 200:
+        if "accept-ranges" not in headers:
+            headers["accept-ranges"] = "bytes"
+        request_headers = request.headers if isinstance(request.headers, Headers) \
+            else Headers._wrap(_header_entries(request.headers))
+        range_header = request_headers.get("range")
+        if request.method == "GET" and range_header is not None \
+           and _if_range_matches(request_headers.get("if-range"), headers):
+            ranges = _parse_ranges(range_header, size)
+
+    if ranges is None:
+        if isinstance(body, RangeSource):
+            headers["content-length"] = str(size)
+            if request.method == "HEAD":
+                # Only the length is needed, so don't fetch the content.
+                _close(body)
+                response.body = None
+            else:
+                response.body = _concat([read(0, size)], body)
+        return response
+
+    if not ranges:
+        _close(body)
+        for name in ("content-length", "content-type", "etag"):
+            if name in headers:
+                del headers[name]
+        headers["content-range"] = f"bytes */{size}"
+        return Response(416, headers, None)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+        headers["content-length"] = str(end - start)
+        return Response(206, headers, _concat([read(start, end)], body))
+
+    boundary = secrets.token_hex(16)
+    content_type = headers.get("content-type")
+    parts: List[Body] = []
+    length = 0
+    for start, end in ranges:
+        part_headers = f"\r\n--{boundary}\r\n"
+        if content_type is not None:
+            part_headers += f"content-type: {content_type}\r\n"
+        part_headers += f"content-range: bytes {start}-{end - 1}/{size}\r\n\r\n"
+        part_head = part_headers.encode("latin-1")
+        parts.append(part_head)
+        parts.append(read(start, end))
+        length += len(part_head) + end - start
+    trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+    parts.append(trailer)
+    length += len(trailer)
+
+    headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+    headers["content-length"] = str(length)
+    return Response(206, headers, _concat(parts, body))
+
+def _parse_ranges(value: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    # Returns `None` if the header should be ignored, an empty list if no
+    # range is satisfiable, or else the (start, end) offsets of each range.
+    unit, _, specs = value.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        first, dash, last = spec.strip().partition("-")
+        if not dash or not (first or last) \
+           or (first and not _is_digits(first)) or (last and not _is_digits(last)):
+            return None
+        if first:
+            start = int(first)
+            end = size
+            if last:
+                end = int(last) + 1
+                if end <= start:
+                    return None
+        else:
+            # A suffix range, i.e. the last `last` bytes
+            if int(last) == 0:
+                continue
+            start = size - int(last)
+            end = size
+        if start < 0:
+            start = 0
+        if start < size:
+            ranges.append((start, min(end, size)))
+    if len(ranges) > _MAX_RANGES:
+        return None
+    return ranges
+
+def _is_digits(value: str) -> bool:
+    # `int` would also accept signs, underscores, whitespace and non-ASCII
+    # digits.
+    return value.isascii() and value.isdigit()
+
+def _if_range_matches(if_range: Optional[str], headers: Headers) -> bool:
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', "W/")):
+        # `if-range` uses the strong comparison function.
+        etag = headers.get("etag")
+        return etag is not None and not etag.startswith("W/") and not if_range.startswith("W/") \
+            and etag.strip() == if_range
+    last_modified = headers.get("last-modified")
+    try:
+        return last_modified is not None \
+            and utils.parsedate_to_datetime(last_modified) == utils.parsedate_to_datetime(if_range)
+    except (TypeError, ValueError):
+        return False
+
+def _file_range(file: BinaryIO, offset: int, length: int) -> Iterator[bytes]:
+    file.seek(offset)
+    while length > 0:
+        chunk = file.read(min(length, poll_loop.READ_SIZE))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+def _concat(parts: List[Body], owner: object) -> Body:
+    # Join `parts` into a single body, closing `owner` once it's been sent.
+    if all(isinstance(part, (bytes, bytearray, memoryview)) for part in parts):
+        _close(owner)
+        return b"".join(cast(List[bytes], parts))
+    if any(isinstance(part, AsyncIterable) and not isinstance(part, Iterable) for part in parts):
+        return _concat_async(parts, owner)
+    return _concat_blocking(parts, owner)
+
+def _concat_blocking(parts: List[Body], owner: object) -> Iterator[bytes]:
+    try:
+        for part in parts:
+            if isinstance(part, (bytes, bytearray, memoryview)):
+                yield bytes(part)
+            else:
+                yield from _chunks(part)
+    finally:
+        _close(owner)
+
+async def _concat_async(parts: List[Body], owner: object) -> AsyncIterator[bytes]:
+    try:
+        for part in parts:
+            if isinstance(part, (bytes, bytearray, memoryview)):
+                yield bytes(part)
+            else:
+                async for chunk in _chunks_async(part):
+                    yield chunk
+    finally:
+        _close(owner)
+
+# Content types which are already compressed and thus not worth compressing
+# again.  Other `image/`, `audio/` and `video/` types are also skipped.
+_COMPRESSED_CONTENT_TYPES = frozenset([
+    "application/gzip", "application/x-gzip", "application/zip", "application/zstd",
+    "application/x-bzip2", "application/x-xz", "application/x-7z-compressed",
+    "application/x-rar-compressed", "application/pdf", "application/octet-stream",
+    "font/woff", "font/woff2",
+])
+
+def _compression_encoding(request: Request, response: Response, min_size: int) -> Optional[str]:
+    # Returns the encoding with which `_compress` should compress `response`,
+    # if any.
+    headers = cast(Headers, response.headers)
+    body = response.body
+
+    if body is None or response.status < 200 or response.status in (204, 206, 304) \
+       or "content-encoding" in headers:
+        return None
+
+    content_type = headers.get("content-type", "").split(";", 1)[0].strip().lower()
+    if content_type in _COMPRESSED_CONTENT_TYPES \
+       or (content_type.startswith(("image/", "audio/", "video/")) and content_type != "image/svg+xml"):
+        return None
+
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        size: Optional[int] = len(body)
+    elif isinstance(body, RangeSource):
+        size = body.size
+    else:
+        size = _content_length(headers)
+    if size is not None and size < min_size:
+        return None
+
+    accept_encoding = ", ".join(request.headers.get_all("accept-encoding")) \
+        if isinstance(request.headers, Headers) else request.headers.get("accept-encoding", "")
+    return _negotiate_encoding(accept_encoding)
+
+def _compress(response: Response, encoding: str, level: int, asynchronous: bool, head: bool) -> Response:
+    headers = cast(Headers, response.headers)
+    # `_ranges` has already replaced any `RangeSource` body with its content
+    # (or, for `HEAD`, with `None`).
+    body = cast(Optional[Body], response.body)
+
+    if (body is None and not head) or response.status < 200 or response.status in (204, 206, 304):
+        # e.g. a 304 from `_conditional`
+        return response
+
+    content_type = headers.get("content-type", "").split(";", 1)[0].strip().lower()
+    # gzip and zlib (i.e. HTTP "deflate") framing, respectively
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+    # Deliver each event as soon as it's produced rather than whenever the
+    # compressor's buffer fills up.
+    mode = zlib.Z_SYNC_FLUSH if content_type == "text/event-stream" else zlib.Z_NO_FLUSH
+
+    new_body: Body
+    if head or body is None:
+        # A `HEAD` response carries the headers a `GET` would, but none of
+        # the content, so there's nothing to compress.  The compressed length
+        # can't be known without compressing, so rather than let `_send_head`
+        # derive `content-length` from the uncompressed body, leave it out.
+        # Other bodies are kept so the handler can close them.
+        new_body = [] if body is None or isinstance(body, (bytes, bytearray, memoryview)) else body
+    elif isinstance(body, (bytes, bytearray, memoryview)):
+        new_body = compressor.compress(body) + compressor.flush()
+    elif asynchronous or (isinstance(body, AsyncIterable) and not isinstance(body, Iterable)):
+        new_body = _compress_chunks_async(_chunks_async(body), compressor, mode)
+    else:
+        new_body = _compress_chunks(_chunks(body), compressor, mode)
+
+    # `accept-ranges` is dropped as byte ranges would refer to the
+    # uncompressed body.
+    for name in ("content-length", "accept-ranges"):
+        if name in headers:
+            del headers[name]
+    headers["content-encoding"] = encoding
+    _mark_compressed(headers)
+    response.body = new_body
+    return response
+
+def _mark_compressed(headers: Headers):
+    # The compressed body is a different sequence of bytes, so a strong ETag
+    # for the original no longer applies.
+    etag = headers.get("etag")
+    if etag is not None and not etag.startswith("W/"):
+        headers["etag"] = "W/" + etag
+    vary = ", ".join(headers.get_all("vary"))
+    if "accept-encoding" not in vary.lower() and vary.strip() != "*":
+        headers.add("vary", "accept-encoding")
+
+def _negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    qualities: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+
+    wildcard = qualities.get("*", 0.0)
+    best = None
+    best_quality = 0.0
+    for encoding in ("gzip", "deflate"):
+        quality = qualities.get(encoding, wildcard)
+        if quality > best_quality:
+            best = encoding
+            best_quality = quality
+    return best
+
+def _chunks(body: Body) -> Iterable[bytes]:
+    if hasattr(body, "read"):
+        file = cast(BinaryIO, body)
+        try:
+            while True:
+                chunk = file.read(poll_loop.READ_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            _close(file)
+    else:
+        iterable = cast(Iterable[bytes], body)
+        try:
+            yield from iterable
+        finally:
+            _close(iterable)
+
+async def _chunks_async(body: Body) -> AsyncIterator[bytes]:
+    if isinstance(body, AsyncIterable):
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            await _aclose(body)
+    else:
+        for chunk in _chunks(body):
+            yield chunk
+
+def _compress_chunks(chunks: Iterable[bytes], compressor: Any, mode: int) -> Iterator[bytes]:
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if mode != zlib.Z_NO_FLUSH:
+            data += compressor.flush(mode)
+        if data:
+            yield data
+    yield compressor.flush()
+
+async def _compress_chunks_async(chunks: AsyncIterable[bytes], compressor: Any, mode: int) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if mode != zlib.Z_NO_FLUSH:
+            data += compressor.flush(mode)
+        if data:
+            yield data
+    yield compressor.flush()
+
+PREALLOCATE_LIMIT: int = poll_loop.MAX_READ_SIZE
+"""Largest buffer `read_body` and `read_body_blocking` allocate before any data has arrived."""
+
+def _preallocation(stream: Stream, content_length: Optional[int]) -> int:
+    if content_length is None:
+        return 0
+    limit = PREALLOCATE_LIMIT if stream.max_size is None else min(PREALLOCATE_LIMIT, stream.max_size)
+    return min(content_length, limit)
+
+def _grow(buffer: bytearray, content_length: Optional[int]) -> bool:
+    # Double the size of the full `buffer`, up to `content_length`, returning
+    # `False` if it's already that big.
+    if content_length is None or len(buffer) >= content_length:
+        return False
+    buffer.extend(bytes(min(max(len(buffer), PREALLOCATE_LIMIT), content_length - len(buffer))))
+    return True
+
+def read_body_blocking(stream: Stream, content_length: Optional[int] = None) -> bytearray:
+    """Read the remainder of `stream`, blocking as necessary.
+
+    If the body's length is known, e.g. from a `content-length` header, pass
+    it as `content_length` so the body can be read directly into a buffer of
+    the right size.  Since the length may come from an untrusted client, at
+    most `PREALLOCATE_LIMIT` bytes (or the stream's `max_size`, if smaller)
+    are allocated up front; the buffer is then doubled in size, up to
+    `content_length`, each time the data which has actually arrived fills it.
+
+    The buffer itself is returned rather than a `bytes` copy of it.
+    """
+    buffer = bytearray(_preallocation(stream, content_length))
+    offset = 0
+    while True:
+        view = memoryview(buffer)
+        while offset < len(buffer):
+            count = stream.blocking_readinto(view[offset:])
+            if count == 0:
+                break
+            offset += count
+        view.release()
+        if offset < len(buffer) or not _grow(buffer, content_length):
+            break
+    del buffer[offset:]
+    # The length was only a hint; pick up anything beyond it.
+    for chunk in stream:
+        buffer += chunk
+    return buffer
+
+async def read_body(stream: Stream, content_length: Optional[int] = None) -> bytearray:
+    """Read the remainder of `stream`, yielding to other tasks as necessary.
+
+    See `read_body_blocking` for a description of `content_length` and the
+    result.
+    """
+    buffer = bytearray(_preallocation(stream, content_length))
+    offset = 0
+    while True:
+        view = memoryview(buffer)
+        while offset < len(buffer):
+            count = await stream.readinto(view[offset:])
+            if count == 0:
+                break
+            offset += count
+        view.release()
+        if offset < len(buffer) or not _grow(buffer, content_length):
+            break
+    del buffer[offset:]
+    async for chunk in stream:
+        buffer += chunk
+    return buffer
+
+def _body_too_large(e: BaseException) -> bool:
+    return isinstance(e, Err) and isinstance(e.value, ErrorCode_HttpRequestBodySize)
+
+def _header_entries(headers: Mapping[str, str]) -> List[Tuple[str, bytes]]:
+    if isinstance(headers, Headers):
+        return headers.entries()
+    return [(name, bytes(value, "utf-8")) for name, value in headers.items()]
+
+def _content_length(headers: Headers) -> Optional[int]:
+    values = headers.get_all("content-length")
+    if len(values) == 1:
+        try:
+            return max(int(values[0]), 0)
+        except ValueError:
+            pass
+    return None
+
+def write_body_blocking(sink: Sink, body: Optional[Body]):
+    """Write the specified body to `sink`, blocking as necessary.
+
+    A `Stream` body is spliced into `sink` by the host without being copied
+    through Python.  Async iterable bodies are driven to completion using
+    `spin_sdk.http.poll_loop.run`.  The
+    data is flushed only once the whole body has been written, and the body's
+    `close` method, if any, is called at that point.
+    """
+    if body is None:
+        return
+    elif isinstance(body, (bytes, bytearray, memoryview)):
+        sink.blocking_send(body)
+    elif isinstance(body, Stream):
+        try:
+            poll_loop.blocking_pipe(body, sink)
+        finally:
+            body.close()
+    elif hasattr(body, "read"):
+        try:
+            while True:
+                chunk = body.read(poll_loop.READ_SIZE)
+                if not chunk:
+                    break
+                sink.blocking_send(chunk)
+        finally:
+            _close(body)
+    elif isinstance(body, Iterable):
+        try:
+            for chunk in body:
+                sink.blocking_send(chunk)
+        finally:
+            _close(body)
+    elif isinstance(body, AsyncIterable):
+        poll_loop.run(write_body(sink, body))
+        return
+    else:
+        raise TypeError(f"unsupported body type: {type(body).__name__}")
+    sink.blocking_flush()
+
+async def write_body(sink: Sink, body: Optional[Body]):
+    """Write the specified body to `sink`, yielding to other tasks as necessary.
+
+    The data is handed to the host as permitted by the stream's backpressure
+    and flushed only once the whole body has been written.  A `Stream` body is
+    spliced into `sink` by the host without being copied through Python.  The body's
+    `close` (or `aclose`) method, if any, is called once it has been written.
+    """
+    if body is None:
+        return
+    elif isinstance(body, (bytes, bytearray, memoryview)):
+        await sink.send(body, flush=False)
+    elif isinstance(body, Stream):
+        try:
+            await poll_loop.pipe(body, sink)
+        finally:
+            body.close()
+    elif hasattr(body, "read"):
+        try:
+            while True:
+                chunk = body.read(poll_loop.READ_SIZE)
+                if not chunk:
+                    break
+                await sink.send(chunk, flush=False)
+        finally:
+            _close(body)
+    elif isinstance(body, AsyncIterable):
+        try:
+            async for chunk in body:
+                await sink.send(chunk, flush=False)
+        finally:
+            await _aclose(body)
+    elif isinstance(body, Iterable):
+        try:
+            for chunk in body:
+                await sink.send(chunk, flush=False)
+        finally:
+            _close(body)
+    else:
+        raise TypeError(f"unsupported body type: {type(body).__name__}")
+    await sink.flush()
+
+def _close(body: object):
+    close = getattr(body, "close", None)
+    if close is not None:
+        close()
+
+async def _aclose(body: object):
+    aclose = getattr(body, "aclose", None)
+    if aclose is not None:
+        await aclose()
+    else:
+        _close(body)
@@ -8,164 +8,728 @@ boilerplate will be needed once those features arrive in Preview 3.
 """
 
 import asyncio
+import heapq
+import math
 import socket
 import subprocess
 
 from spin_sdk.wit.types import Ok, Err
-from spin_sdk.wit.imports import types, streams, poll, outgoing_handler
-from spin_sdk.wit.imports.types import IncomingBody, OutgoingBody, OutgoingRequest, IncomingResponse
+from spin_sdk.wit.imports import types, streams, poll, outgoing_handler, monotonic_clock
+from spin_sdk.wit.imports.types import (
+    IncomingBody, OutgoingBody, OutgoingRequest, IncomingResponse, RequestOptions, ErrorCode_HttpRequestBodySize,
+    ErrorCode_HttpResponseBodySize
+)
 from spin_sdk.wit.imports.streams import StreamError_Closed, InputStream
 from spin_sdk.wit.imports.poll import Pollable
-from typing import Optional, cast
+from asyncio.log import logger
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar, Union, cast
 
-# Maximum number of bytes to read at a time
+T = TypeVar("T")
+
+# Number of bytes initially requested per read by `Stream.next`
 READ_SIZE: int = 16 * 1024
 
-async def send(request: OutgoingRequest) -> IncomingResponse:
-    """Send the specified request and wait asynchronously for the response."""
+# Default bounds within which `Stream.next` adapts its read size
+MIN_READ_SIZE: int = 4 * 1024
+MAX_READ_SIZE: int = 1024 * 1024
+
+# Maximum number of bytes to move per `blocking_splice` call
+SPLICE_SIZE: int = 1024 * 1024
+
+# Cancelled timers are purged from the heap once there are at least this many
+# timers and more than this fraction of them are cancelled, as in
+# `asyncio.BaseEventLoop`.
+_MIN_SCHEDULED_TIMER_HANDLES = 100
+_MIN_CANCELLED_TIMER_HANDLES_FRACTION = 0.5
+
+async def send(request: OutgoingRequest, options: Optional[RequestOptions] = None) -> IncomingResponse:
+    """Send the specified request and wait asynchronously for the response.
+
+    `options`, if specified, is passed on to the host.  If the calling task is cancelled before the response arrives, the
+    pending response is dropped, which tells the host to abandon the request.
+    """
     
-    future = outgoing_handler.handle(request, None)
+    future = outgoing_handler.handle(request, options)
 
-    while True:
-        response = future.get()
-        if response is None:
-            await register(cast(PollLoop, asyncio.get_event_loop()), future.subscribe())
-        else:
-            future.__exit__(None, None, None)
-            
-            if isinstance(response, Ok):
-                if isinstance(response.value, Ok):
-                    return response.value.value
-                else:
-                    raise response.value
+    try:
+        while True:
+            response = future.get()
+            if response is None:
+                await register(cast(PollLoop, asyncio.get_event_loop()), future.subscribe())
             else:
-                raise response
+                break
+    finally:
+        future.__exit__(None, None, None)
+
+    if isinstance(response, Ok):
+        if isinstance(response.value, Ok):
+            return response.value.value
+        else:
+            raise response.value
+    else:
+        raise response
 
 class Stream:
-    """Reader abstraction over `wasi:http/types#incoming-body`."""
-    def __init__(self, body: IncomingBody):
+    """Reader abstraction over `wasi:http/types#incoming-body`.
+
+    Besides calling `next` directly, a `Stream` may be consumed using `async
+    for` (which yields to the event loop while waiting for data) or a plain
+    `for` loop (which blocks until each chunk arrives).
+
+    If `body` was consumed from an `IncomingResponse`, pass that as `response`
+    so it is kept alive until the body is finished and released along with it.
+
+    The number of bytes requested per chunk adapts to the observed data rate:
+    it doubles (up to `max_read_size`) each time a read fills the request
+    and halves (down to `min_read_size`) each time a read returns less than
+    half of it.  This keeps the number of host calls low for large bodies
+    without over-allocating for small ones.  Pass equal bounds for a fixed
+    read size.
+
+    If `max_size` is specified, the stream is closed and an error is raised as
+    soon as more than that many bytes have been read (or spliced) from it:
+    `Err(ErrorCode_HttpResponseBodySize)` if `response` was given, otherwise
+    `Err(ErrorCode_HttpRequestBodySize)`.
+    """
+    def __init__(
+        self,
+        body: IncomingBody,
+        response: Optional[IncomingResponse] = None,
+        min_read_size: int = MIN_READ_SIZE,
+        max_read_size: int = MAX_READ_SIZE,
+        max_size: Optional[int] = None
+    ):
         self.body: Optional[IncomingBody] = body
         self.stream: Optional[InputStream] = body.stream()
+        self.response = response
+        self.min_read_size = min_read_size
+        self.max_read_size = max_read_size
+        self.read_size = min(max(READ_SIZE, min_read_size), max_read_size)
+        self.max_size = max_size
+        self.bytes_read = 0
 
     async def next(self) -> Optional[bytes]:
         """Wait for the next chunk of data to arrive on the stream.
 
         This will return `None` when the end of the stream has been reached.
         """
+        return self._adapt(await self._read(self.read_size))
+
+    def blocking_next(self) -> Optional[bytes]:
+        """Block until the next chunk of data arrives on the stream.
+
+        This will return `None` when the end of the stream has been reached.
+        """
+        return self._adapt(self._blocking_read(self.read_size))
+
+    def _adapt(self, chunk: Optional[bytes]) -> Optional[bytes]:
+        if chunk is not None:
+            if len(chunk) >= self.read_size:
+                self.read_size = min(self.read_size * 2, self.max_read_size)
+            elif len(chunk) < self.read_size // 2:
+                self.read_size = max(self.read_size // 2, self.min_read_size)
+        return chunk
+
+    async def readinto(self, buffer: Union[bytearray, memoryview]) -> int:
+        """Wait for data to arrive on the stream and copy up to `len(buffer)`
+        bytes of it into `buffer`.
+
+        This returns the number of bytes read, which will be zero only if the
+        end of the stream has been reached (or `buffer` is empty).
+        """
+        if len(buffer) == 0:
+            return 0
+        return _copy_into(buffer, await self._read(len(buffer)))
+
+    def blocking_readinto(self, buffer: Union[bytearray, memoryview]) -> int:
+        """Like `readinto`, but blocks until data arrives."""
+        if len(buffer) == 0:
+            return 0
+        return _copy_into(buffer, self._blocking_read(len(buffer)))
+
+    async def read_exact(self, n: int) -> bytes:
+        """Read exactly `n` bytes from the stream.
+
+        If the end of the stream is reached first, this raises
+        `asyncio.IncompleteReadError` holding the bytes which were read.
+        """
+        buffer = bytearray(n)
+        view = memoryview(buffer)
+        offset = 0
+        while offset < n:
+            count = await self.readinto(view[offset:])
+            if count == 0:
+                raise asyncio.IncompleteReadError(bytes(view[:offset]), n)
+            offset += count
+        return bytes(buffer)
+
+    def blocking_read_exact(self, n: int) -> bytes:
+        """Like `read_exact`, but blocks until data arrives."""
+        buffer = bytearray(n)
+        view = memoryview(buffer)
+        offset = 0
+        while offset < n:
+            count = self.blocking_readinto(view[offset:])
+            if count == 0:
+                raise asyncio.IncompleteReadError(bytes(view[:offset]), n)
+            offset += count
+        return bytes(buffer)
+
+    async def _read(self, size: int) -> Optional[bytes]:
         while True:
             try:
                 if self.stream is None:
                     return None
                 else:
-                    buffer = self.stream.read(READ_SIZE)
+                    buffer = self.stream.read(self._limit(size))
                     if len(buffer) == 0:
                         await register(cast(PollLoop, asyncio.get_event_loop()), self.stream.subscribe())
                     else:
+                        self._count(len(buffer))
                         return buffer
             except Err as e:
                 if isinstance(e.value, StreamError_Closed):
-                    if self.stream is not None:
-                        self.stream.__exit__(None, None, None)
-                        self.stream = None
-                    if self.body is not None:
-                        IncomingBody.finish(self.body)
-                        self.body = None
+                    self.close()
                 else:
                     raise e
 
+    def _blocking_read(self, size: int) -> Optional[bytes]:
+        while True:
+            try:
+                if self.stream is None:
+                    return None
+                else:
+                    buffer = self.stream.blocking_read(self._limit(size))
+                    if len(buffer) != 0:
+                        self._count(len(buffer))
+                        return buffer
+            except Err as e:
+                if isinstance(e.value, StreamError_Closed):
+                    self.close()
+                else:
+                    raise e
+
+    def _limit(self, size: int) -> int:
+        # Don't read more than one byte past `max_size`; that's enough to tell
+        # that the limit has been exceeded.
+        if self.max_size is None:
+            return size
+        return max(min(size, self.max_size - self.bytes_read + 1), 1)
+
+    def _count(self, size: int):
+        self.bytes_read += size
+        if self.max_size is not None and self.bytes_read > self.max_size:
+            too_large = self.response is not None
+            self.close()
+            if too_large:
+                raise Err(ErrorCode_HttpResponseBodySize(self.bytes_read))
+            else:
+                raise Err(ErrorCode_HttpRequestBodySize(self.bytes_read))
+
+    def close(self):
+        """Release the stream and finish the body, discarding any unread data."""
+
+        if self.stream is not None:
+            self.stream.__exit__(None, None, None)
+            self.stream = None
+        if self.body is not None:
+            IncomingBody.finish(self.body)
+            self.body = None
+        if self.response is not None:
+            self.response.__exit__(None, None, None)
+            self.response = None
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self
+
+    def __next__(self) -> bytes:
+        chunk = self.blocking_next()
+        if chunk is None:
+            raise StopIteration
+        return chunk
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self
+
+    async def __anext__(self) -> bytes:
+        chunk = await self.next()
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
 class Sink:
-    """Writer abstraction over `wasi-http/types#outgoing-body`."""
-    def __init__(self, body: OutgoingBody):
+    """Writer abstraction over `wasi-http/types#outgoing-body`.
+
+    By default, each chunk passed to `send` is handed to the host right away.
+    If `high_water_mark` is specified, small writes are instead coalesced in
+    a buffer which is only written out once it holds at least that many bytes,
+    when `flush` is called, when the sink is closed, or (if `flush_interval` is
+    specified) once that many seconds have passed since data was last
+    buffered by `send`.  This reduces the number of host calls needed to
+    stream many small records such as NDJSON lines or server-sent events.
+    """
+    def __init__(self, body: OutgoingBody, high_water_mark: Optional[int] = None, flush_interval: Optional[float] = None):
         self.body = body
         self.stream = body.write()
-
-    async def send(self, chunk: bytes):
+        self.high_water_mark = high_water_mark
+        self.flush_interval = flush_interval
+        self.buffer = bytearray()
+        # Held while buffered data is being written out, so that concurrent
+        # drains can't interleave their writes.
+        self.lock = asyncio.Lock()
+        self.flush_timer: Optional[asyncio.TimerHandle] = None
+
+    async def send(self, chunk: Union[bytes, bytearray, memoryview], flush: bool = True):
         """Write the specified bytes to the sink.
 
         This may need to yield according to the backpressure requirements of the sink.
+
+        If `flush` is `False`, the data is handed to the host without waiting
+        for it to be flushed; call `flush` once a batch of writes is complete.
+        `flush` is ignored if the sink is buffered.
+        """
+        if self.high_water_mark is None:
+            await self._write_all(chunk)
+            if flush:
+                await self._flush_stream()
+        else:
+            self.buffer += chunk
+            if len(self.buffer) >= self.high_water_mark:
+                await self._drain()
+            elif self.flush_interval is not None and self.flush_timer is None:
+                self.flush_timer = asyncio.get_event_loop().call_later(self.flush_interval, self._flush_buffer_now)
+
+    async def flush(self):
+        """Write out any buffered data and flush the stream, yielding until the flush completes."""
+        async with self.lock:
+            await self._drain_locked()
+            await self._flush_stream()
+
+    def blocking_send(self, chunk: Union[bytes, bytearray, memoryview]):
+        """Write the specified bytes to the sink, blocking as necessary.
+
+        Unlike `send`, this does not flush; call `blocking_flush` when done.
         """
+        if self.high_water_mark is None:
+            self._blocking_write_all(chunk)
+        else:
+            self.buffer += chunk
+            if len(self.buffer) >= self.high_water_mark:
+                self._blocking_drain()
+
+    def blocking_flush(self):
+        """Write out any buffered data and flush the stream, blocking until the flush completes."""
+        self._blocking_drain()
+        self.stream.blocking_flush()
+
+    async def _write_all(self, chunk: Union[bytes, bytearray, memoryview]):
         offset = 0
-        flushing = False
-        while True:
+        while offset < len(chunk):
             count = self.stream.check_write()
             if count == 0:
                 await register(cast(PollLoop, asyncio.get_event_loop()), self.stream.subscribe())
-            elif offset == len(chunk):
-                if flushing:
-                    return
-                else:
-                    self.stream.flush()
-                    flushing = True
             else:
-                count = min(count, len(chunk) - offset)
-                self.stream.write(chunk[offset:offset+count])
-                offset += count
+                offset += self._write(chunk, offset, count)
+
+    def _blocking_write_all(self, chunk: Union[bytes, bytearray, memoryview]):
+        offset = 0
+        while offset < len(chunk):
+            count = self.stream.check_write()
+            if count == 0:
+                with self.stream.subscribe() as pollable:
+                    pollable.block()
+            else:
+                offset += self._write(chunk, offset, count)
+
+    async def _flush_stream(self):
+        self.stream.flush()
+        while self.stream.check_write() == 0:
+            await register(cast(PollLoop, asyncio.get_event_loop()), self.stream.subscribe())
+
+    def _write(self, chunk: Union[bytes, bytearray, memoryview], offset: int, count: int) -> int:
+        # Hand the caller's buffer to the host as-is whenever it fits in the
+        # permitted write, avoiding a copy.
+        if offset == 0 and len(chunk) <= count and isinstance(chunk, bytes):
+            self.stream.write(chunk)
+            return len(chunk)
+        count = min(count, len(chunk) - offset)
+        self.stream.write(bytes(memoryview(chunk)[offset:offset+count]))
+        return count
+
+    async def _drain(self):
+        async with self.lock:
+            await self._drain_locked()
+
+    async def _drain_locked(self):
+        self._cancel_flush_timer()
+        if self.buffer:
+            # Swap the buffer out so that `send` can keep appending while we
+            # wait for the stream to accept this data.  Anything appended
+            # meanwhile is written by the next drain, which waits for the lock.
+            data = self.buffer
+            self.buffer = bytearray()
+            await self._write_all(data)
+
+    def _blocking_drain(self):
+        self._cancel_flush_timer()
+        if self.buffer:
+            data = self.buffer
+            self.buffer = bytearray()
+            self._blocking_write_all(data)
+
+    def _flush_buffer_now(self):
+        # Called by the loop once `flush_interval` has elapsed.  We can't
+        # wait here, so write whatever the stream will accept right now and
+        # try again later for the rest.  If a drain is already in progress, it
+        # must complete first to keep the data in order.
+        self.flush_timer = None
+        if self.stream is None or not self.buffer:
+            return
+
+        if not self.lock.locked():
+            written = 0
+            while written < len(self.buffer):
+                count = self.stream.check_write()
+                if count == 0:
+                    break
+                written += self._write(self.buffer, written, count)
+            if written > 0:
+                del self.buffer[:written]
+                self.stream.flush()
+
+        if self.buffer:
+            self.flush_timer = asyncio.get_event_loop().call_later(self.flush_interval, self._flush_buffer_now)
+
+    def _cancel_flush_timer(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
 
     def close(self):
-        """Close the stream, indicating no further data will be written."""
+        """Close the stream, indicating no further data will be written.
 
+        Any buffered data is written out first, blocking if necessary; call
+        `flush` beforehand to avoid blocking the event loop.
+        """
+
+        self._blocking_drain()
+        self.stream.blocking_flush()
         self.stream.__exit__(None, None, None)
         self.stream = None
         OutgoingBody.finish(self.body, None)
         self.body = None
+
+    def abort(self):
+        """Close the stream without finishing the body.
+
+        The receiver will treat the body as incomplete, e.g. by aborting the
+        request or response it belongs to.  Any buffered data is discarded.
+        """
+
+        self._cancel_flush_timer()
+        self.buffer = bytearray()
+        self.stream.__exit__(None, None, None)
+        self.stream = None
+        self.body.__exit__(None, None, None)
+        self.body = None
         
+@dataclass
+class LoopStats:
+    """Counters and timings collected by a `PollLoop`.
+
+    Times are in seconds, measured using `wasi:clocks/monotonic-clock`.
+    """
+    iterations: int = 0
+    """Number of times the loop has run its ready callbacks."""
+    poll_calls: int = 0
+    """Number of calls to `wasi:io/poll#poll`."""
+    poll_time: float = 0.0
+    """Total time spent blocked in `wasi:io/poll#poll`."""
+    handles_run: int = 0
+    """Total number of callbacks (e.g. task steps) run."""
+    max_handles_per_iteration: int = 0
+    """Largest number of callbacks run in a single iteration."""
+    longest_step: float = 0.0
+    """Longest time taken by a single callback.  Only measured in debug mode."""
+    slow_callbacks: int = 0
+    """Number of callbacks which took at least `PollLoop.slow_callback_duration`.
+    Only counted in debug mode."""
+
+    @property
+    def mean_handles_per_iteration(self) -> float:
+        return self.handles_run / self.iterations if self.iterations else 0.0
+
 class PollLoop(asyncio.AbstractEventLoop):
-    """Custom `asyncio` event loop backed by `wasi:io/poll#poll`."""
+    """Custom `asyncio` event loop backed by `wasi:io/poll#poll`.
+
+    Rather than constructing one of these directly, use `get_loop` or `run`,
+    which reuse a single loop for the lifetime of the component instance.
+
+    `run_until_complete` may be called re-entrantly, i.e. from synchronous
+    code running inside a task on this loop.  The calling task is suspended
+    while the nested call runs the loop (including any other tasks) until its
+    future is done, which lets blocking helpers such as
+    `spin_sdk.http.send` be used from `async` code without creating another
+    loop.
+
+    Each loop keeps a `LoopStats` in `stats`, which may be read after
+    `run_until_complete` returns.  If `stats_callback` is set, it is also
+    called with the stats each time an outermost `run_until_complete` call
+    returns.  In debug mode (see `set_debug`), the time taken by each
+    callback is measured as well, and any callback taking at least
+    `slow_callback_duration` seconds is logged as a warning, as in the
+    standard `asyncio` debug mode.  This helps find CPU-bound code which
+    delays other tasks' I/O.
+    """
     
     def __init__(self):
-        self.wakers = []
+        # `pollables[i]` is the pollable which will resolve `wakers[i]`.  These
+        # are kept as parallel lists so they can be passed to `poll.poll`
+        # as-is and updated in place, touching only the ready entries.
+        # `indexes` maps each waker back to its position, so that a cancelled
+        # waiter can be removed without searching for it.
+        self.pollables: List[Pollable] = []
+        self.wakers: List[asyncio.Future] = []
+        self.indexes: Dict[asyncio.Future, int] = {}
         self.running = False
+        self.depth = 0
+        self.stopping = False
+        self.closed = False
         self.handles = []
+        self.timers: List[asyncio.TimerHandle] = []
+        # Number of cancelled timers still in `timers`
+        self.cancelled_timers = 0
         self.exception = None
+        self.clock_resolution: Optional[float] = None
+        self.debug = False
+        self.slow_callback_duration = 0.1
+        self.stats = LoopStats()
+        self.stats_callback: Optional[Callable[[LoopStats], None]] = None
 
     def get_debug(self):
-        return False
+        return self.debug
+
+    def set_debug(self, enabled: bool):
+        self.debug = enabled
+
+    def reset_stats(self):
+        """Discard the stats collected so far."""
+        self.stats = LoopStats()
 
     def run_until_complete(self, future):
+        if self.closed:
+            raise RuntimeError("Event loop is closed")
         future = asyncio.ensure_future(future, loop=self)
 
+        # If this is a nested call, the task which made it is still marked as
+        # current and would prevent any other task from running.
+        outer_task = asyncio.current_task(self) if self.depth > 0 else None
+        if outer_task is not None:
+            asyncio.tasks._leave_task(self, outer_task)
+        outer_loop = asyncio.events._get_running_loop()
+
+        self.depth += 1
         self.running = True
         asyncio.events._set_running_loop(self)
-        while self.running and not future.done():
-            handles = self.handles
-            self.handles = []
-            for handle in handles:
-                if not handle._cancelled:
-                    handle._run()
-                
-            if self.wakers:
-                [pollables, wakers] = list(map(list, zip(*self.wakers)))
-                
-                new_wakers = []
-                ready = [False] * len(pollables)
-                for index in poll.poll(pollables):
-                    ready[index] = True
-                
-                for (ready, pollable), waker in zip(zip(ready, pollables), wakers):
-                    if ready:
-                        pollable.__exit__(None, None, None)
-                        waker.set_result(None)
-                    else:
-                        new_wakers.append((pollable, waker))
-
-                self.wakers = new_wakers
-
-            if self.exception is not None:
-                raise self.exception
-            
+        try:
+            while not self.stopping and not future.done():
+                self._run_once()
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                self.running = False
+                self.stopping = False
+            asyncio.events._set_running_loop(outer_loop)
+            if outer_task is not None:
+                asyncio.tasks._enter_task(self, outer_task)
+            if self.depth == 0 and self.stats_callback is not None:
+                self.stats_callback(self.stats)
+
+        if not future.done():
+            raise RuntimeError("Event loop stopped before Future completed.")
         return future.result()
 
+    def _run_once(self):
+        stats = self.stats
+        handles = self.handles
+        self.handles = []
+        count = 0
+        for handle in handles:
+            if not handle._cancelled:
+                if self.debug:
+                    self._run_timed(handle)
+                else:
+                    handle._run()
+                count += 1
+        stats.iterations += 1
+        stats.handles_run += count
+        if count > stats.max_handles_per_iteration:
+            stats.max_handles_per_iteration = count
+
+        if len(self.timers) > _MIN_SCHEDULED_TIMER_HANDLES \
+           and self.cancelled_timers > len(self.timers) * _MIN_CANCELLED_TIMER_HANDLES_FRACTION:
+            timers = []
+            for handle in self.timers:
+                if handle._cancelled:
+                    handle._scheduled = False
+                else:
+                    timers.append(handle)
+            heapq.heapify(timers)
+            self.timers = timers
+            self.cancelled_timers = 0
+        else:
+            while self.timers and self.timers[0]._cancelled:
+                heapq.heappop(self.timers)._scheduled = False
+                self.cancelled_timers -= 1
+
+        if self.handles:
+            # More callbacks are ready to run, so only check for
+            # readiness without blocking.
+            timeout = monotonic_clock.subscribe_duration(0) if self.wakers else None
+        elif self.timers:
+            # Block until either a pollable is ready or the earliest timer
+            # is due.
+            timeout = monotonic_clock.subscribe_instant(math.ceil(self.timers[0].when() * 1e9))
+        else:
+            timeout = None
+
+        if self.wakers or timeout is not None:
+            pollables = self.pollables
+            if timeout is not None:
+                pollables.append(timeout)
+
+            start = monotonic_clock.now()
+            ready = poll.poll(pollables)
+            stats.poll_time += (monotonic_clock.now() - start) / 1e9
+            stats.poll_calls += 1
+
+            if timeout is not None:
+                pollables.pop()
+                timeout.__exit__(None, None, None)
+
+            # Visit ready entries from last to first so that each one can
+            # be replaced by the current last entry without disturbing the
+            # indexes yet to be visited.
+            ready.sort(reverse=True)
+            for index in ready:
+                if index == len(pollables):
+                    # The timeout fired
+                    continue
+                pollable, waker = self._remove(index)
+                pollable.__exit__(None, None, None)
+                # The waiting task may have been cancelled since this was
+                # registered.
+                if not waker.done():
+                    waker.set_result(None)
+
+        if self.timers:
+            if self.clock_resolution is None:
+                self.clock_resolution = monotonic_clock.resolution() / 1e9
+            end = self.time() + self.clock_resolution
+            while self.timers and self.timers[0].when() <= end:
+                handle = heapq.heappop(self.timers)
+                handle._scheduled = False
+                if handle._cancelled:
+                    self.cancelled_timers -= 1
+                else:
+                    self.handles.append(handle)
+
+        if self.exception is not None:
+            exception = self.exception
+            self.exception = None
+            raise exception
+
+    def _run_timed(self, handle: asyncio.Handle):
+        start = monotonic_clock.now()
+        handle._run()
+        duration = (monotonic_clock.now() - start) / 1e9
+        if duration > self.stats.longest_step:
+            self.stats.longest_step = duration
+        if duration >= self.slow_callback_duration:
+            self.stats.slow_callbacks += 1
+            logger.warning("Executing %r took %.3f seconds", handle, duration)
+
+    def _add(self, pollable: Pollable, waker: asyncio.Future):
+        self.indexes[waker] = len(self.wakers)
+        self.pollables.append(pollable)
+        self.wakers.append(waker)
+
+    def _remove(self, index: int) -> Tuple[Pollable, asyncio.Future]:
+        # Replace the entry with the last one rather than shifting the rest.
+        pollable = self.pollables[index]
+        waker = self.wakers[index]
+        last_pollable = self.pollables.pop()
+        last_waker = self.wakers.pop()
+        if index < len(self.wakers):
+            self.pollables[index] = last_pollable
+            self.wakers[index] = last_waker
+            self.indexes[last_waker] = index
+        del self.indexes[waker]
+        return pollable, waker
+
     def is_running(self):
         return self.running
 
     def is_closed(self):
-        return not self.running
+        return self.closed
 
     def stop(self):
-        self.running = False
+        self.stopping = True
 
     def close(self):
-        self.running = False
+        """Close the loop, releasing any pollables still registered with it."""
+        if self.running:
+            raise RuntimeError("Cannot close a running event loop")
+        if self.closed:
+            return
+        self.closed = True
+        self._discard()
+
+    def reset(self):
+        """Cancel any tasks still pending on the loop and discard any other
+        state left behind by previous runs.
+
+        As `asyncio.run` does before closing its loop, the cancelled tasks
+        are run until they finish, so they can release their resources.  Any
+        callbacks, timers and waiters which remain after that, e.g. because a
+        run ended with an exception, are dropped, as is any error not yet
+        raised from `run_until_complete`.
+        """
+        if self.running:
+            raise RuntimeError("Cannot reset a running event loop")
+        tasks = [task for task in asyncio.all_tasks(self) if not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            gathered = asyncio.gather(*tasks, return_exceptions=True)
+            while not gathered.done():
+                try:
+                    self.run_until_complete(gathered)
+                except Exception:
+                    # e.g. an earlier task's unretrieved error, reported when
+                    # it was garbage collected
+                    logger.exception("Error while cancelling leftover tasks")
+            for task in tasks:
+                if task.done() and not task.cancelled() and task.exception() is not None:
+                    logger.error("Unhandled exception in task %r", task, exc_info=task.exception())
+        self._discard()
+        self.exception = None
+        self.stopping = False
+
+    def _discard(self):
+        for pollable in self.pollables:
+            pollable.__exit__(None, None, None)
+        for waker in self.wakers:
+            waker.cancel()
+        for handle in self.timers:
+            handle._scheduled = False
+        self.pollables = []
+        self.wakers = []
+        self.indexes = {}
+        self.handles = []
+        self.timers = []
+        self.cancelled_timers = 0
 
     def shutdown_asyncgens(self):
         pass
@@ -178,6 +742,24 @@ class PollLoop(asyncio.AbstractEventLoop):
         self.handles.append(handle)
         return handle
 
+    def call_later(self, delay, callback, *args, context=None):
+        return self.call_at(self.time() + delay, callback, *args, context=context)
+
+    def call_at(self, when, callback, *args, context=None):
+        handle = asyncio.TimerHandle(when, callback, args, self, context)
+        heapq.heappush(self.timers, handle)
+        handle._scheduled = True
+        return handle
+
+    def _timer_handle_cancelled(self, handle):
+        # Cancelled timers are discarded once they reach the front of the
+        # heap, or in bulk by `_run_once` once enough of them accumulate.
+        if handle._scheduled:
+            self.cancelled_timers += 1
+
+    def time(self):
+        return monotonic_clock.now() / 1e9
+
     def create_task(self, coroutine):
         return asyncio.Task(coroutine, loop=self)
 
@@ -192,18 +774,6 @@ class PollLoop(asyncio.AbstractEventLoop):
     async def shutdown_default_executor(self):
         raise NotImplementedError
 
-    def _timer_handle_cancelled(self, handle):
-        raise NotImplementedError
-
-    def call_later(self, delay, callback, *args, context=None):
-        raise NotImplementedError
-
-    def call_at(self, when, callback, *args, context=None):
-        raise NotImplementedError
-
-    def time(self):
-        raise NotImplementedError
-
     def call_soon_threadsafe(self, callback, *args, context=None):
         raise NotImplementedError
 
@@ -362,10 +932,108 @@ class PollLoop(asyncio.AbstractEventLoop):
     def default_exception_handler(self, context):
         raise NotImplementedError
 
-    def set_debug(self, enabled):
-        raise NotImplementedError
+
+def _copy_into(buffer: Union[bytearray, memoryview], chunk: Optional[bytes]) -> int:
+    if chunk is None:
+        return 0
+    memoryview(buffer)[:len(chunk)] = chunk
+    return len(chunk)
+
+async def pipe(stream: Stream, sink: Sink):
+    """Move the remaining contents of `stream` to `sink`.
+
+    The data is transferred by the host using `wasi:io/streams#splice` rather
+    than being copied through Python.  `stream` is closed once exhausted;
+    `sink` is left open.
+    """
+    loop = cast(PollLoop, asyncio.get_event_loop())
+    await sink._drain()
+    while stream.stream is not None:
+        try:
+            count = sink.stream.check_write()
+            if count == 0:
+                await register(loop, sink.stream.subscribe())
+            else:
+                count = sink.stream.splice(stream.stream, stream._limit(count))
+                if count == 0:
+                    await register(loop, stream.stream.subscribe())
+                else:
+                    stream._count(count)
+        except Err as e:
+            if isinstance(e.value, StreamError_Closed):
+                _finish_pipe(stream, sink)
+            else:
+                raise e
+
+def blocking_pipe(stream: Stream, sink: Sink):
+    """Move the remaining contents of `stream` to `sink`, blocking as necessary.
+
+    See `pipe` for details.
+    """
+    sink._blocking_drain()
+    while stream.stream is not None:
+        try:
+            stream._count(sink.stream.blocking_splice(stream.stream, stream._limit(SPLICE_SIZE)))
+        except Err as e:
+            if isinstance(e.value, StreamError_Closed):
+                _finish_pipe(stream, sink)
+            else:
+                raise e
+
+def _finish_pipe(stream: Stream, sink: Sink):
+    # `splice` reports `closed` for either end, so check whether it was the
+    # sink (which is an error) or the end of the source (which isn't).
+    sink.stream.check_write()
+    stream.close()
+
+_loop: Optional[PollLoop] = None
+
+def get_loop() -> PollLoop:
+    """Return the `PollLoop` for this component instance.
+
+    This is the currently running `PollLoop`, if any.  Otherwise, a loop is
+    created on first use (or if the previous one was closed), installed as
+    the current event loop using `asyncio.set_event_loop`, and reused by
+    subsequent calls.
+    """
+    global _loop
+    running = asyncio.events._get_running_loop()
+    if isinstance(running, PollLoop):
+        return running
+    if _loop is None or _loop.is_closed():
+        _loop = PollLoop()
+    asyncio.set_event_loop(_loop)
+    return _loop
+
+def run(future: Awaitable[T]) -> T:
+    """Run `future` to completion on the loop returned by `get_loop`.
+
+    This may be called from synchronous code running inside a task on that
+    loop, in which case the loop is run re-entrantly until `future` is done.
+    """
+    return get_loop().run_until_complete(future)
+
+def reset():
+    """Reset the loop returned by `get_loop`, if one has been created.
+
+    See `PollLoop.reset`.  Incoming handlers call this once each request has
+    been handled, so nothing left running on the shared loop by one request
+    (e.g. a task started using `asyncio.ensure_future` and never awaited)
+    can affect the next.
+    """
+    if _loop is not None and not _loop.is_closed() and not _loop.is_running():
+        _loop.reset()
 
 async def register(loop: PollLoop, pollable: Pollable):
     waker = loop.create_future()
-    loop.wakers.append((pollable, waker))
-    await waker
+    loop._add(pollable, waker)
+    try:
+        await waker
+    except asyncio.CancelledError:
+        # Stop polling on behalf of the cancelled task, unless the pollable
+        # was already found to be ready (and released) by the loop.
+        index = loop.indexes.get(waker)
+        if index is not None:
+            loop._remove(index)
+            pollable.__exit__(None, None, None)
+        raise